@@ -5,13 +5,277 @@ This module contains classes that allow for consistent and performant access
 of a file's metadata.
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 import hashlib
+import io
+import os
 import sqlite3
-from typing import Optional
+import sys
+from typing import Callable, Iterable, Optional
 from file_tracker import utils
 
 CHUNK_SIZE = 64000000 #64MB
+SMALL_FILE_SIZE = 1000000 #1MB
+# Past this many concurrent reads, most SSDs stop getting any faster.
+DEFAULT_HASH_WORKERS = min(os.cpu_count() or 1, 8)
+# Reads the next block of a large file in the background while the current one
+# is hashed, see `_hash_fileobj`. It is shared by every hash, so its threads
+# are only started once, and a thread each covers `DEFAULT_HASH_WORKERS` files
+# being hashed at once.
+_READER = ThreadPoolExecutor(max_workers=DEFAULT_HASH_WORKERS, thread_name_prefix="hash-reader")
+
+def _cpu_has_sha_ni() -> bool:
+    """Checks whether the CPU advertises the Intel SHA extensions (SHA-NI)."""
+    try:
+        with open("/proc/cpuinfo", mode="rt", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return "sha_ni" in line.split()
+    except OSError:
+        pass
+    return False
+
+class _CryptographySha256:
+    """Wraps `cryptography`'s SHA256 so it looks like a `hashlib` object."""
+    def __init__(self, hashes) -> None:
+        self._ctx = hashes.Hash(hashes.SHA256())
+
+    def update(self, data: bytes) -> None:
+        self._ctx.update(data)
+
+    def digest(self) -> bytes:
+        return self._ctx.finalize()
+
+def _select_sha256_factory() -> Callable:
+    """
+    Picks the fastest SHA256 implementation available at import time.
+
+    `hashlib.sha256` is backed by OpenSSL on most builds, which already
+    dispatches to SHA-NI on CPUs that support it. Only when `hashlib` had to
+    fall back to CPython's builtin implementation, and the CPU has SHA-NI, do
+    we try routing through the OpenSSL bundled with `cryptography` instead.
+    """
+    if hashlib.sha256.__name__ == "openssl_sha256" or not _cpu_has_sha_ni():
+        return hashlib.sha256
+
+    try:
+        from cryptography.hazmat.primitives import hashes # type: ignore[import-not-found]
+    except ImportError:
+        return hashlib.sha256
+
+    return lambda: _CryptographySha256(hashes)
+
+_sha256_factory = _select_sha256_factory()
+
+# Every content hash a database can be created with. SHA256 is always
+# available, BLAKE3 only if the optional `blake3` package is installed.
+HASH_ALGORITHMS: dict[str, Callable] = {"sha256": _sha256_factory}
+DEFAULT_HASH_ALGORITHM = "sha256"
+# Replacements for hash constructors that use several threads per file, used
+# by `hash_many`. It already keeps the CPU busy with several files at once,
+# where more threads per file would only compete with each other.
+_SINGLE_THREADED_HASH_FACTORIES: dict[Callable, Callable] = {}
+
+try:
+    import blake3 # type: ignore[import-not-found]
+except ImportError:
+    pass
+else:
+    def _blake3_multithreaded():
+        # BLAKE3 is a tree hash, so unlike SHA256 it can spread a single large
+        # file over several cores.
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+    HASH_ALGORITHMS["blake3"] = _blake3_multithreaded
+    _SINGLE_THREADED_HASH_FACTORIES[_blake3_multithreaded] = blake3.blake3
+
+def _get_hash_factory(hash_algorithm: str) -> Callable:
+    """Returns the hash constructor for `hash_algorithm`, or raises a `ValueError`."""
+    try:
+        return HASH_ALGORITHMS[hash_algorithm]
+    except KeyError:
+        if hash_algorithm == "blake3":
+            raise ValueError(
+                "Hash algorithm 'blake3' requires the 'blake3' package to be installed."
+            ) from None
+        raise ValueError(f"Unsupported hash algorithm: '{hash_algorithm}'.") from None
+
+def _open_for_hashing(path: str | Path) -> io.FileIO:
+    """
+    Opens `path` for unbuffered binary reading.
+
+    Where supported, the file is opened with `O_NOATIME` so that scanning a
+    filesystem doesn't turn into a write for every file we read.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    noatime = getattr(os, "O_NOATIME", 0)
+    if noatime:
+        try:
+            return io.FileIO(os.open(path, flags | noatime), mode="rb")
+        except PermissionError:
+            # O_NOATIME is only allowed on files we own.
+            pass
+    return io.FileIO(os.open(path, flags), mode="rb")
+
+def _fadvise(f: io.FileIO, offset: int, length: int, advice: str) -> None:
+    """
+    Passes an access pattern hint for `f` to the kernel. Does nothing on
+    platforms without `os.posix_fadvise`.
+    """
+    try:
+        os.posix_fadvise(f.fileno(), offset, length, getattr(os, advice))
+    except AttributeError:
+        pass
+
+def _hash_fileobj(f: io.FileIO,
+                  size: int,
+                  buffer: Optional[bytearray]=None,
+                  hash_factory: Callable=_sha256_factory
+                 ) -> bytes:
+    """
+    Hashes the contents of `f`, which is expected to be `size` bytes long.
+
+    Files spanning more than one `CHUNK_SIZE` block are read through two
+    reusable buffers: while one block is being hashed, the next one is already
+    being read in the background by `_READER`, so the disk doesn't sit idle
+    while we hash. Both `readinto` and `update` release the GIL, letting the
+    two overlap.
+
+    If a `buffer` larger than the file is given, the file is read straight into
+    it instead, which lets a batch of small files share a single allocation.
+    Other files that fit in one block are read with `hashlib.file_digest`
+    where available.
+
+    The file is hashed with SHA256, unless another `hash_factory` is given.
+    """
+    sha = hash_factory()
+    if buffer is not None and size < len(buffer):
+        view = memoryview(buffer)
+        while bytes_read := f.readinto(view):
+            sha.update(view[:bytes_read])
+        return sha.digest()
+
+    if size <= CHUNK_SIZE:
+        # Not worth a pipeline, or allocating `CHUNK_SIZE` buffers.
+        if sys.version_info >= (3, 11):
+            # Reads through one small reusable buffer, instead of allocating a
+            # `bytes` object as large as the whole file.
+            return hashlib.file_digest(f, lambda: sha).digest()
+        while data := f.read(CHUNK_SIZE):
+            sha.update(data)
+        return sha.digest()
+
+    buffers = (bytearray(CHUNK_SIZE), bytearray(CHUNK_SIZE))
+    current = 0
+    pending = _READER.submit(f.readinto, buffers[current])
+    try:
+        while bytes_read := pending.result():
+            block = memoryview(buffers[current])[:bytes_read]
+            current ^= 1
+            pending = _READER.submit(f.readinto, buffers[current])
+            sha.update(block)
+    finally:
+        # The caller closes `f` next, so no read into it can be left running.
+        if not pending.cancel():
+            wait((pending,))
+    return sha.digest()
+
+def hash_many(files: Iterable["FileMetadata"],
+              workers: Optional[int]=None,
+              ignore_errors: bool=False
+             ) -> dict[str, bytes]:
+    """
+    Hashes many files concurrently.
+
+    SHA256 has a long serial dependency chain, so a single stream leaves most
+    of the CPU idle. Hashing several independent files side by side keeps more
+    of it busy, and since `hashlib` releases the GIL while it reads and hashes
+    large buffers, a thread per stream is enough to get there. Every hash is
+    cached on its `FileMetadata` object, exactly as if `hash` was accessed.
+
+    Args:
+        files:
+          The `FileMetadata` objects to hash.
+        workers:
+          How many files to hash at once. Defaults to `DEFAULT_HASH_WORKERS`.
+        ignore_errors:
+          Whether to skip files that can't be read (such as on a
+          `PermissionError`) instead of raising. Skipped files are left out of
+          the results, and their hash stays uncomputed.
+
+    Returns:
+        A dict mapping each file's `path_str` to its hash.
+    """
+    files = list(files)
+    if len(files) < 2:
+        return hash_small_files_batch(files, ignore_errors)
+
+    workers = min(workers or DEFAULT_HASH_WORKERS, len(files))
+    small_files = [x for x in files if x.size < SMALL_FILE_SIZE]
+    large_files = [x for x in files if x.size >= SMALL_FILE_SIZE]
+
+    results: dict[str, bytes] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Small files are split into one batch per worker, so they are still
+        # hashed in parallel without paying a task (and buffer) per file.
+        small_batches = [small_files[i::workers] for i in range(workers)]
+        large_batches = [[file] for file in large_files]
+        futures = [executor.submit(_hash_batch, batch, ignore_errors, True)
+                   for batch in small_batches + large_batches if batch]
+        for future in futures:
+            results.update(future.result())
+    return results
+
+def hash_small_files_batch(files: Iterable["FileMetadata"],
+                           ignore_errors: bool=False
+                          ) -> dict[str, bytes]:
+    """
+    Hashes a batch of small files, one after another.
+
+    Each file smaller than `SMALL_FILE_SIZE` is read with a single `readinto`
+    into one buffer shared by the whole batch, instead of allocating a fresh
+    `bytes` object per file. Larger files are hashed as usual.
+
+    Args:
+        files:
+          The `FileMetadata` objects to hash.
+        ignore_errors:
+          See `hash_many`.
+
+    Returns:
+        A dict mapping each file's `path_str` to its hash.
+    """
+    return _hash_batch(files, ignore_errors)
+
+def _hash_batch(files: Iterable["FileMetadata"],
+                ignore_errors: bool=False,
+                single_threaded: bool=False
+               ) -> dict[str, bytes]:
+    """
+    Implements `hash_small_files_batch`. With `single_threaded`, each file is
+    hashed on the calling thread only, see `_SINGLE_THREADED_HASH_FACTORIES`.
+    """
+    buffer: Optional[bytearray] = None
+    results = {}
+    for file in files:
+        try:
+            if file._hash is None:
+                hash_factory = file._hash_factory
+                if single_threaded:
+                    hash_factory = _SINGLE_THREADED_HASH_FACTORIES.get(hash_factory, hash_factory)
+
+                if file.size < SMALL_FILE_SIZE:
+                    if buffer is None:
+                        buffer = bytearray(SMALL_FILE_SIZE)
+                    file._compute_hash(buffer, hash_factory)
+                else:
+                    file._compute_hash(hash_factory=hash_factory)
+            results[file.path_str] = file.hash
+        except OSError:
+            if not ignore_errors:
+                raise
+    return results
 
 class FileMetadata:
     """
@@ -23,9 +287,14 @@ class FileMetadata:
 
     Attributes:
         hash:
-          A `bytes` object representing the SHA256 hash of the file.
+          A `bytes` object representing the hash of the file, computed with
+          `hash_algorithm` (SHA256 by default).
+        hash_hex:
+          The hash of the file as a hex string.
         path:
           A `path` object of the files location.
+        path_str:
+          The files location as a string.
         size:
           File size in bytes.
         mtime:
@@ -34,19 +303,32 @@ class FileMetadata:
           The filesystem ID that the file is stored on. This ID is unique per
           filesystem.
     """
-    def __init__(self, path: Path) -> None:
+    # A scan can hold many of these at once, so skip the per-instance dict.
+    __slots__ = ("_path", "_path_str", "_size", "_mtime", "_dev", "_hash",
+                 "_fs_id", "_hash_hex", "_hash_factory", "_sql_dict_nohash",
+                 "_sql_dict_withhash")
+
+    def __init__(self,
+                 path: Path,
+                 hash_algorithm: str=DEFAULT_HASH_ALGORITHM
+                ) -> None:
         """
         Use given `Path` object to init FileMetadata object.
 
         Args:
             path:
               `Path` object representing the file to obtain metadata from.
+            hash_algorithm:
+              Which algorithm in `HASH_ALGORITHMS` to hash the file with. This
+              should match the database the file is stored in.
 
         Raises:
             FileNotFoundError:
               There is no file with the given `path`.
             TypeError:
               The `path` given points to a symlink. This is unsupported.
+            ValueError:
+              The `hash_algorithm` given is unsupported.
         """
         if not isinstance(path, Path):
             raise TypeError("Path argument isn't a pathlib.Path object.")
@@ -55,12 +337,81 @@ class FileMetadata:
         if path.is_symlink():
             raise TypeError(f"Given path points to a symlink, which is unsupported: {path}")
 
-        self._path = path.resolve(strict=True)
-        stat = path.stat()
+        resolved = path.resolve(strict=True)
+        self._init_metadata(str(resolved), path.stat(), hash_algorithm, resolved)
+
+    @classmethod
+    def from_dir_entry(cls,
+                       entry: os.DirEntry,
+                       resolve: bool=False,
+                       hash_algorithm: str=DEFAULT_HASH_ALGORITHM
+                      ) -> "FileMetadata":
+        """
+        Creates a `FileMetadata` object from an `os.DirEntry`.
+
+        The constructor stats the file several times over to validate and
+        resolve it. This instead relies on the file type and stat result that
+        `entry` caches, which costs at most one syscall per file, so callers
+        that iterate over directories with `os.scandir` should prefer it.
+
+        Args:
+            entry:
+              An `os.DirEntry` pointing to the file to obtain metadata from.
+            resolve:
+              Whether to resolve the path of `entry`. Paths yielded by
+              `os.scandir` are only absolute and resolved if the directory
+              being scanned was, so only leave this off in that case.
+            hash_algorithm:
+              See `__init__`.
+
+        Raises:
+            FileNotFoundError:
+              `entry` isn't a file.
+            TypeError:
+              `entry` points to a symlink. This is unsupported.
+            ValueError:
+              The `hash_algorithm` given is unsupported.
+        """
+        if not isinstance(entry, os.DirEntry):
+            raise TypeError("Entry argument isn't an os.DirEntry object.")
+        if entry.is_symlink():
+            raise TypeError(f"Given entry points to a symlink, which is unsupported: {entry.path}")
+        if not entry.is_file(follow_symlinks=False):
+            raise FileNotFoundError(f"Given entry '{entry.path}' is not a file.")
+
+        file_metadata = cls.__new__(cls)
+        stat = entry.stat(follow_symlinks=False)
+        if resolve:
+            path = Path(entry.path).resolve(strict=True)
+            file_metadata._init_metadata(str(path), stat, hash_algorithm, path)
+        else:
+            # Most files scanned are only ever used by their path string, so
+            # the `Path` is only built if it is asked for.
+            file_metadata._init_metadata(entry.path, stat, hash_algorithm)
+        return file_metadata
+
+    def _init_metadata(self,
+                       path_str: str,
+                       stat: os.stat_result,
+                       hash_algorithm: str,
+                       path: Optional[Path]=None
+                      ) -> None:
+        """
+        Inits all attributes from an already validated `path_str` and its
+        `stat`. If the `Path` of the file is already at hand, it can be given
+        as `path`.
+        """
+        self._hash_factory = _get_hash_factory(hash_algorithm)
+        self._path: Optional[Path] = path
+        self._path_str = path_str
         self._size = stat.st_size
         self._mtime = stat.st_mtime_ns
+        self._dev = stat.st_dev
         self._hash: Optional[bytes] = None
         self._fs_id: Optional[int] = None
+        self._sql_dict_nohash: Optional[dict] = None
+        self._sql_dict_withhash: Optional[dict] = None
+        self._hash_hex: Optional[str] = None
 
     def __eq__(self, other):
         if not isinstance(other, FileMetadata):
@@ -85,31 +436,111 @@ class FileMetadata:
             Whether to include the hash in the dict. If `False`, the hash is
             `None`. Set to `False` if you don't need the hash, as it requires
             reading the entire file from disk.
+
+        Returns:
+            A dict that is cached and shared between calls, so it must not be
+            modified.
         """
-        return {
-            "path": str(self.path),
+        if include_hash and self._sql_dict_withhash is not None:
+            return self._sql_dict_withhash
+        if not include_hash and self._sql_dict_nohash is not None:
+            return self._sql_dict_nohash
+
+        sql_dict = {
+            "path": self.path_str,
             "size": self.size,
             "mtime": self.mtime,
             "hash": self.hash if include_hash else None,
             "fs_id": self.fs_id
         }
 
+        # Neither variant can go stale: the hash only ever goes from unknown
+        # to known, and the variant without it never contains it.
+        if include_hash:
+            self._sql_dict_withhash = sql_dict
+        else:
+            self._sql_dict_nohash = sql_dict
+        return sql_dict
+
+    def as_sql_tuple(self, include_hash: bool=False) -> tuple:
+        """
+        Returns all metadata about the file as a tuple.
+
+        This holds the same values as `as_sql_dict`, in the order of the
+        database's columns: `(path, hash, size, mtime, fs_id)`. Binding a
+        tuple to positional parameters is cheaper than binding a dict by name.
+
+        Args:
+          include_hash:
+            See `as_sql_dict`.
+        """
+        return (
+            self.path_str,
+            self.hash if include_hash else None,
+            self.size,
+            self.mtime,
+            self.fs_id
+        )
+
+    def adopt_hash_if_unchanged(self, other: "FileMetadata") -> bool:
+        """
+        Reuses the hash of `other` if it describes the same file contents.
+
+        If the size and mtime of `other` (usually the copy of this file stored
+        in the database) match this file's, its hash is cached on this object,
+        so the file never has to be read from disk.
+
+        Returns:
+            Whether the hash of `other` was adopted.
+        """
+        if self._hash is not None:
+            return False
+        if self._size != other.size or self._mtime != other.mtime:
+            return False
+
+        self._hash = other.hash
+        return True
+
     @property
     def hash(self) -> bytes:
         """The hash of the file as a `bytes` object."""
         if self._hash is not None:
             return self._hash
 
-        print(f"Hashing {self._path}...")
-        sha = hashlib.sha256()
-        with self._path.open(mode="rb") as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if data:
-                    sha.update(data)
-                else:
-                    break
-            self._hash = sha.digest()
+        return self._compute_hash()
+
+    @property
+    def hash_hex(self) -> str:
+        """The hash of the file as a hex string."""
+        if self._hash_hex is None:
+            self._hash_hex = self.hash.hex()
+        return self._hash_hex
+
+    def _compute_hash(self,
+                      buffer: Optional[bytearray]=None,
+                      hash_factory: Optional[Callable]=None
+                     ) -> bytes:
+        """
+        Reads the file from disk and caches its hash.
+
+        Args:
+            buffer:
+              An optional scratch buffer to read the file into. See
+              `hash_small_files_batch`.
+            hash_factory:
+              The hash constructor to use instead of the one for the file's
+              `hash_algorithm`. It must compute the same hash.
+        """
+        print(f"Hashing {self._path_str}...")
+        with _open_for_hashing(self._path_str) as f:
+            # Let the kernel read ahead aggressively, but only prefetch the
+            # first block up front, so huge files don't flood the page cache.
+            _fadvise(f, 0, 0, "POSIX_FADV_SEQUENTIAL")
+            _fadvise(f, 0, CHUNK_SIZE, "POSIX_FADV_WILLNEED")
+            self._hash = _hash_fileobj(f, self._size, buffer, hash_factory or self._hash_factory)
+            # We won't read this file again, so a scan shouldn't push hotter
+            # data out of the page cache.
+            _fadvise(f, 0, 0, "POSIX_FADV_DONTNEED")
 
             # This protects against edits happening in between the time of caching
             # the mtime in the constructor, and actually running the `hash` function.
@@ -119,7 +550,7 @@ class FileMetadata:
             # the file was edited while we were hashing it, which could result in an invalid hash.
             # AFAICT, this doesn't necessarily have any big ramifications, but I think it is better
             # to error out than to put known inaccurate info into the database.
-            if self._path.stat().st_mtime_ns != self._mtime:
+            if os.stat(self._path_str).st_mtime_ns != self._mtime:
                 raise RuntimeError("A program is editing files while we are scanning files. This can result in inconsistencies the database.")
 
             return self._hash
@@ -128,10 +559,22 @@ class FileMetadata:
     def path(self) -> Path:
         """
         The path of the file, as a `Path` object.
-        The path is always represented in absolute/resolved form.
+        The path is represented in absolute/resolved form, except for objects
+        made by `from_dir_entry` with `resolve` off, which keep the path of
+        the entry as is. Those are only resolved if the directory scanned was.
         """
+        if self._path is None:
+            self._path = Path(self._path_str)
         return self._path
 
+    @property
+    def path_str(self) -> str:
+        """
+        The path of the file, as a string. Cheaper than `str(self.path)`, as
+        it is only converted once.
+        """
+        return self._path_str
+
     @property
     def size(self) -> int:
         """The size of the file in bytes."""
@@ -148,9 +591,21 @@ class FileMetadata:
         if self._fs_id is not None:
             return self._fs_id
 
-        self._fs_id = utils.get_fsid(self._path)
+        self._fs_id = utils.get_fsid(self._path_str, self._dev)
         return self._fs_id
 
+class SharedRowValues:
+    """
+    The values `DbFileMetadata.from_sql_tuple` shares between the rows of a
+    query. Each parent directory and each fs_id is only kept once, in a table
+    of its own.
+    """
+    __slots__ = ("parents", "fs_ids")
+
+    def __init__(self) -> None:
+        self.parents: dict[str, str] = {}
+        self.fs_ids: dict[int, int] = {}
+
 class DbFileMetadata(FileMetadata):
     """
     Creates an object representing a file from precomputed metadata.
@@ -163,6 +618,11 @@ class DbFileMetadata(FileMetadata):
     Attributes:
         See `FileMetadata`'s attributes.
     """
+    # The parent directory and name of the file are stored separately, so the
+    # parent can be shared with every other file in the same directory. The
+    # full path, as a string or a `Path`, is only built if it is asked for.
+    __slots__ = ("_parent", "_name")
+
     def __init__(self, file_dict: dict | sqlite3.Row) -> None:
         """
         Inits a `DbFileMetadata` object based upon values in given `file_dict`.
@@ -185,11 +645,94 @@ class DbFileMetadata(FileMetadata):
         if not isinstance(file_dict["fs_id"], int):
             raise TypeError("file_dict['fs_id'] wasn't of type int.")
 
-        self._path: Path = Path(file_dict["path"])
-        self._hash: bytes = file_dict["hash"]
-        self._size: int = file_dict["size"]
-        self._mtime: int = file_dict["mtime"]
-        self._fs_id: int = file_dict["fs_id"]
+        self._init_from_values(file_dict["path"], file_dict["hash"], file_dict["size"], file_dict["mtime"], file_dict["fs_id"])
+
+    @classmethod
+    def from_trusted_row(cls, row: dict | sqlite3.Row) -> "DbFileMetadata":
+        """
+        Creates a `DbFileMetadata` object from a row of the file metadata
+        database, without validating any of its values.
+
+        The database schema already guarantees every column's type, so rows
+        read back from it don't need the checks `__init__` does for other
+        callers. Only pass rows that come straight from a `FileMetadataDb`.
+        """
+        file_metadata = cls.__new__(cls)
+        file_metadata._init_from_values(row["path"], row["hash"], row["size"], row["mtime"], row["fs_id"])
+        return file_metadata
+
+    @classmethod
+    def from_sql_tuple(cls,
+                       row: tuple,
+                       shared: Optional[SharedRowValues]=None
+                      ) -> "DbFileMetadata":
+        """
+        Creates a `DbFileMetadata` object from a plain tuple row of the file
+        metadata database, without validating any of its values.
+
+        This is the inverse of `FileMetadata.as_sql_tuple`, and otherwise
+        behaves like `from_trusted_row`. Plain tuples are cheaper for sqlite3
+        to build than `sqlite3.Row` objects.
+
+        Args:
+            row:
+              A tuple in the order of `FileMetadata.as_sql_tuple`.
+            shared:
+              A `SharedRowValues` to pass for every row of the same query.
+              Rows repeat the same few values over and over: every file in a
+              directory has the same parent, and there are only a handful of
+              fs_ids. With this, all of them share a single object per value,
+              for only as long as the caller keeps it around.
+        """
+        path, file_hash, size, mtime, fs_id = row
+        file_metadata = cls.__new__(cls)
+        file_metadata._init_from_values(path, file_hash, size, mtime, fs_id, shared)
+        return file_metadata
+
+    def _init_from_values(self,
+                          path: str,
+                          file_hash: bytes,
+                          size: int,
+                          mtime: int,
+                          fs_id: int,
+                          shared: Optional[SharedRowValues]=None
+                         ) -> None:
+        """
+        Inits all attributes from already validated values. See
+        `from_sql_tuple` for `shared`.
+        """
+        parent, sep, name = path.rpartition(os.sep)
+        parent += sep
+        if shared is not None:
+            parent = shared.parents.setdefault(parent, parent)
+            fs_id = shared.fs_ids.setdefault(fs_id, fs_id)
+        self._parent: str = parent
+        self._name: str = name
+        # `_path_str` is left unset until `path_str` first joins the two.
+        self._path = None
+        self._hash: bytes = file_hash
+        self._size: int = size
+        self._mtime: int = mtime
+        self._fs_id: int = fs_id
+        self._sql_dict_nohash = None
+        self._sql_dict_withhash = None
+        self._hash_hex = None
+
+    @property
+    def path(self) -> Path:
+        """See base class."""
+        if self._path is None:
+            self._path = Path(self.path_str)
+        return self._path
+
+    @property
+    def path_str(self) -> str:
+        """See base class."""
+        try:
+            return self._path_str
+        except AttributeError:
+            self._path_str = self._parent + self._name
+            return self._path_str
 
     # We should never need to calculate a hash from a DbFile
     @property
@@ -2,16 +2,112 @@
 Handles creation and modification of file metadata in a centralized database.
 """
 
+import functools
+import itertools
 import re
 import sqlite3
 import sys
+import weakref
+from contextlib import contextmanager
 from pathlib import Path
 from sqlite3.dbapi2 import Connection
-from typing import Generator, Optional
+from typing import Any, Generator, Iterable, Optional
+
+from file_tracker.file_metadata import (
+    DEFAULT_HASH_ALGORITHM,
+    HASH_ALGORITHMS,
+    DbFileMetadata,
+    FileMetadata,
+    SharedRowValues
+)
+
+# How many rows to fetch from sqlite at a time when yielding many files.
+_FETCH_SIZE = 1000
+# How many paths to look up with each `IN (...)` query. Older SQLite versions
+# allow at most 999 parameters per statement.
+_LOOKUP_BATCH_SIZE = 500
+# How many files to write to sqlite with each `executemany`.
+_WRITE_BATCH_SIZE = 1000
+# How many compiled statements each connection keeps around for reuse.
+_STATEMENT_CACHE_SIZE = 256
+
+# Characters that end the literal start of a regex, see `_literal_prefix`.
+_REGEX_SPECIAL_CHARS = frozenset(".^$*+?{}[]()\\")
+
+# Bumped whenever the schema changes, see `_migrate`.
+_SCHEMA_VERSION = 3
+
+# Queries are kept as constants so every call hits sqlite3's statement cache.
+# Every query yielding files selects these, in the order of `FileMetadata.as_sql_tuple`.
+_FILE_COLUMNS = "path, hash, size, mtime, fs_id"
+# The file name part of `path`, split on either separator. `idx_files_name`
+# indexes this exact expression, so queries must use it unchanged.
+_SQL_FILE_NAME = "substr(path, length(rtrim(path, replace(replace(path, '/', ''), '\\', ''))) + 1)"
+_SQL_GET = f"SELECT {_FILE_COLUMNS} FROM files WHERE path = ?"
+_SQL_EXISTS = "SELECT 1 FROM files WHERE path = ?"
+_SQL_GET_HASH = "SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?"
+_SQL_GET_ALL = f"SELECT {_FILE_COLUMNS} FROM files"
+_SQL_MATCHING_HASH = f"SELECT {_FILE_COLUMNS} FROM files WHERE hash = ?"
+_SQL_MATCHING_NAME = f"SELECT {_FILE_COLUMNS} FROM files WHERE {_SQL_FILE_NAME} GLOB ?"
+_SQL_MATCHING_REGEX = f"SELECT {_FILE_COLUMNS} FROM files WHERE path REGEXP ?"
+_SQL_MATCHING_REGEX_RANGE = f"SELECT {_FILE_COLUMNS} FROM files WHERE path >= ? AND path < ? AND path REGEXP ?"
+# Writes bind the tuples of `FileMetadata.as_sql_tuple` positionally.
+_SQL_INSERT = "INSERT INTO files (path, hash, size, mtime, fs_id) VALUES (?, ?, ?, ?, ?)"
+# Unlike `INSERT OR REPLACE`, this updates rows in place, and leaves rows that
+# haven't changed alone entirely.
+_SQL_UPSERT = """
+    INSERT INTO files (path, hash, size, mtime, fs_id) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (path) DO UPDATE SET
+        hash = excluded.hash, size = excluded.size, mtime = excluded.mtime, fs_id = excluded.fs_id
+    WHERE hash != excluded.hash OR size != excluded.size OR mtime != excluded.mtime OR fs_id != excluded.fs_id
+"""
+_SQL_UPDATE = "UPDATE files SET hash = ?2, size = ?3, mtime = ?4, fs_id = ?5 WHERE path = ?1"
+_SQL_DELETE = "DELETE FROM files WHERE path = ?"
+# Every lookup is by path, so the rows are stored in the path index itself
+# instead of a separate rowid table. This also makes the hash index hold the
+# path, so it alone can answer duplicate searches.
+_SQL_CREATE_FILES = """
+    CREATE TABLE {table} (
+        path text primary key not null,
+        hash blob not null,
+        size int not null,
+        mtime int not null,
+        fs_id int not null
+    ) WITHOUT ROWID;
+"""
+_SQL_CREATE_INDEXES = (
+    "CREATE INDEX idx_files_hash ON files(hash);",
+    f"CREATE INDEX idx_files_name ON files({_SQL_FILE_NAME});"
+)
+
 
-from file_tracker.file_metadata import DbFileMetadata, FileMetadata
+@functools.lru_cache(maxsize=32)
+def _compile_regex(regex: str) -> re.Pattern:
+    """
+    Compiles `regex`. The `REGEXP` function is called once per row, and this
+    saves looking the pattern up in `re`'s own cache every time.
+    """
+    return re.compile(regex)
 
 
+def _close_connection(conn: Connection, readonly: bool) -> None:
+    """
+    Closes `conn`, discarding any uncommitted changes.
+
+    Writable connections first move everything in the WAL back into the
+    database and truncate it, so the next open doesn't start with a large WAL
+    to go through.
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    if not readonly:
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        except sqlite3.Error:
+            # Not being able to checkpoint shouldn't stop us from closing.
+            pass
+    conn.close()
+
 class FileMetadataDb:
     """
     Connects to or optionally creates a new file metadata database.
@@ -21,11 +117,18 @@ class FileMetadataDb:
     the custom SQLite database. Most functions expect a `FileMetadata`
     object to operate on.
 
+    Changes are never committed implicitly. The first change after a commit
+    opens a transaction, which stays open until `commit` is called, or is
+    managed explicitly with `transaction`.
+
     Attributes:
         readonly:
           A bool representing whether database is in readonly mode.
         db_path:
           A `Path` of where the database exists.
+        hash_algorithm:
+          The name of the algorithm every hash in the database is computed
+          with.
         in_transaction:
           A bool representing whether there are uncommited changes to the
           database.
@@ -34,7 +137,8 @@ class FileMetadataDb:
     def __init__(self,
                  db_path: Path,
                  readonly: bool=True,
-                 create_new_db: bool=False
+                 create_new_db: bool=False,
+                 hash_algorithm: str=DEFAULT_HASH_ALGORITHM
                 ) -> None:
         """
         Opens an existing database, or creates and initializes a new
@@ -50,6 +154,10 @@ class FileMetadataDb:
             create_new_db:
               Whether to create a new database. If true, the `db_path` given
               must not point to an existing file.
+            hash_algorithm:
+              Which algorithm in `HASH_ALGORITHMS` a new database hashes files
+              with. Existing databases keep the algorithm they were created
+              with.
 
         Returns:
             A FileMetadataDb object.
@@ -57,7 +165,7 @@ class FileMetadataDb:
         Raises:
             ValueError:
               `readonly` was set to true, but you're trying to create a new
-              database.
+              database, or the `hash_algorithm` given is unsupported.
             FileExistsError:
               Raised when attempting to create a new database, but file already
               exists at given `db_path`.
@@ -75,12 +183,23 @@ class FileMetadataDb:
         self._is_closed = False
 
         if create_new_db:
-            self._conn = self._bootstrap_new_db(self._db_path)
+            self._conn = self._bootstrap_new_db(self._db_path, hash_algorithm)
         else:
             self._conn = self._connect_to_existing_db(self._db_path)
+        self._hash_algorithm = self._read_hash_algorithm(self._conn)
 
+        self._tune_connection(self._conn, self._readonly)
         self._conn.row_factory = sqlite3.Row
         self._conn.create_function("REGEXP", 2, FileMetadataDb._sql_regex, deterministic=True)
+        # Shared by every single-row lookup. Anything that yields rows lazily
+        # needs a cursor of its own, so that a lookup made while iterating
+        # doesn't reset it. Its rows are plain tuples.
+        self._cur = self._conn.cursor()
+        self._cur.row_factory = None
+
+        # Makes sure the connection is closed (and checkpointed) even if
+        # `close` is never called, say after a crash outside of a `with`.
+        self._finalizer = weakref.finalize(self, _close_connection, self._conn, self._readonly)
 
     def __enter__(self) -> "FileMetadataDb":
         return self
@@ -95,14 +214,11 @@ class FileMetadataDb:
         if not isinstance(file_metadata, FileMetadata):
             raise TypeError("File given isn't a FileMetadata object.")
 
-        cur = self._conn.cursor()
-        cur.execute("SELECT * FROM files WHERE path = :path", file_metadata.as_sql_dict())
-        result: Optional[sqlite3.Row] = cur.fetchone()
-        cur.close()
+        result: Optional[tuple] = self._fetch_one(_SQL_GET, (file_metadata.path_str,))
         if result is None:
             return None
         else:
-            return DbFileMetadata(result)
+            return DbFileMetadata.from_sql_tuple(result)
 
     def does_exist(self, file_metadata: FileMetadata) -> bool:
         """
@@ -112,14 +228,71 @@ class FileMetadataDb:
         if not isinstance(file_metadata, FileMetadata):
             raise TypeError("File given isn't a FileMetadata object.")
 
-        cur = self._conn.cursor()
-        cur.execute("SELECT 1 FROM files WHERE path = :path", file_metadata.as_sql_dict())
-        result: Optional[sqlite3.Row] = cur.fetchone()
-        cur.close()
+        result: Optional[tuple] = self._fetch_one(_SQL_EXISTS, (file_metadata.path_str,))
         return result is not None
 
+    def get_files_many(self, paths: Iterable[str | Path]) -> list[DbFileMetadata]:
+        """
+        Finds the files in the database with any of the given `paths`.
+
+        Rather than one query per path, the paths are looked up
+        `_LOOKUP_BATCH_SIZE` at a time, with a single `IN (...)` query each.
+        Every file is fetched before returning, so the database can be
+        modified while going through them.
+
+        Returns:
+            A list of `DbFileMetadata` objects, one for each of the `paths`
+            that exist in the database, in no particular order.
+        """
+        files: list[DbFileMetadata] = []
+        paths_iter = map(str, paths)
+        while batch := tuple(itertools.islice(paths_iter, _LOOKUP_BATCH_SIZE)):
+            placeholders = ", ".join("?" * len(batch))
+            files.extend(self._execute_and_yield_files(f"SELECT {_FILE_COLUMNS} FROM files WHERE path IN ({placeholders})", batch))
+        return files
+
+    def does_exist_many(self, paths: Iterable[str | Path]) -> set[str]:
+        """
+        Checks which of the given `paths` exist in the database.
+
+        This behaves like calling `does_exist` on each path, but the paths
+        are checked `_LOOKUP_BATCH_SIZE` at a time, with one query each.
+
+        Returns:
+            The set of paths, as strings, that exist in the database.
+        """
+        existing: set[str] = set()
+        paths_iter = map(str, paths)
+        while batch := tuple(itertools.islice(paths_iter, _LOOKUP_BATCH_SIZE)):
+            placeholders = ", ".join("?" * len(batch))
+            self._cur.execute(f"SELECT path FROM files WHERE path IN ({placeholders})", batch)
+            existing.update(x[0] for x in self._cur.fetchall())
+        return existing
+
+    def get_hash_if_metadata_matches(self,
+                                     path: str | Path,
+                                     size: int,
+                                     mtime: int
+                                    ) -> bytes | None:
+        """
+        Returns the stored hash of the file at `path`, but only if the database
+        still has the given `size` and `mtime` on record for it.
+
+        This lets a scan reuse a known hash without constructing a
+        `DbFileMetadata` object for the file first.
+        """
+        result: Optional[tuple] = self._fetch_one(_SQL_GET_HASH, (str(path), size, mtime))
+        if result is None:
+            return None
+        else:
+            return result[0]
+
     def add_file(self, file_metadata: FileMetadata) -> None:
-        """Adds the file `file_metadata` to the database."""
+        """
+        Adds the file `file_metadata` to the database.
+
+        Callers adding many files at once should prefer `add_files`.
+        """
         # TODO: Should we catch the case if we insert an already existing
         # file into the database again? If we try, _conn.execute raises
         # sqlite3.IntegrityError: UNIQUE constraint failed: files.path
@@ -128,25 +301,97 @@ class FileMetadataDb:
         if not isinstance(file_metadata, FileMetadata):
             raise TypeError("File given isn't a FileMetadata object.")
 
-        sql_dict = file_metadata.as_sql_dict(include_hash=True)
-        self._conn.execute("INSERT INTO files (path, hash, size, mtime, fs_id) VALUES (:path, :hash, :size, :mtime, :fs_id)", sql_dict)
+        # Same statement as `add_files`, minus the batching, so a single file
+        # is only validated once.
+        self._begin_if_needed()
+        self._cur.execute(_SQL_INSERT, file_metadata.as_sql_tuple(include_hash=True))
 
     def update_file(self, file_metadata: FileMetadata) -> None:
         """
         Updates an existing file's metadata based on given `file_metadata`.
+
+        Callers updating many files at once should prefer `update_files`.
         """
         if self._readonly:
             raise RuntimeError("Can't update a file while in read-only mode.")
         if not isinstance(file_metadata, FileMetadata):
             raise TypeError("File given isn't a FileMetadata object.")
 
-        cur = self._conn.cursor()
-        sql_dict = file_metadata.as_sql_dict(include_hash=True)
-        cur.execute("UPDATE files SET hash = :hash, size = :size, mtime = :mtime, fs_id = :fs_id WHERE path = :path", sql_dict)
-        cur.close()
-        if cur.rowcount < 1:
+        self._begin_if_needed()
+        self._cur.execute(_SQL_UPDATE, file_metadata.as_sql_tuple(include_hash=True))
+        if self._cur.rowcount < 1:
             raise FileNotFoundError(f"Updating file failed because it doesn't exist in the database: {file_metadata.path}")
 
+    def add_files(self, files: Iterable[FileMetadata]) -> None:
+        """
+        Adds every file in `files` to the database.
+
+        This behaves like calling `add_file` on each file, but the files are
+        inserted with one `executemany` per `_WRITE_BATCH_SIZE` files, as part
+        of the current transaction. Nothing is committed until `commit` is
+        called.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't add new files while in read-only mode.")
+
+        self._begin_if_needed()
+        for batch in FileMetadataDb._iter_sql_tuple_batches(files):
+            self._cur.executemany(_SQL_INSERT, batch)
+
+    def update_files(self, files: Iterable[FileMetadata]) -> None:
+        """
+        Updates the metadata of every file in `files`, all of which must
+        already exist in the database.
+
+        Like `add_files`, the files are written in batches, as part of the
+        current transaction.
+
+        Raises:
+            FileNotFoundError:
+              One or more of the files don't exist in the database. Files of
+              earlier batches may already have been updated.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't update files while in read-only mode.")
+
+        self._begin_if_needed()
+        for batch in FileMetadataDb._iter_sql_tuple_batches(files):
+            self._cur.executemany(_SQL_UPDATE, batch)
+            if self._cur.rowcount < len(batch):
+                raise FileNotFoundError("Updating files failed because one or more don't exist in the database.")
+
+    def upsert_file(self, file_metadata: FileMetadata) -> None:
+        """
+        Adds the file `file_metadata` to the database, or updates its metadata
+        if it already exists.
+
+        This saves checking whether the file exists with a separate query
+        first. Callers upserting many files at once should prefer
+        `upsert_files`.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't add or update a file while in read-only mode.")
+        if not isinstance(file_metadata, FileMetadata):
+            raise TypeError("File given isn't a FileMetadata object.")
+
+        self._begin_if_needed()
+        self._cur.execute(_SQL_UPSERT, file_metadata.as_sql_tuple(include_hash=True))
+
+    def upsert_files(self, files: Iterable[FileMetadata]) -> None:
+        """
+        Adds every file in `files` to the database, replacing the metadata of
+        any file that already exists in it.
+
+        Like `add_files`, the files are written in batches, as part of the
+        current transaction.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't add or update files while in read-only mode.")
+
+        self._begin_if_needed()
+        for batch in FileMetadataDb._iter_sql_tuple_batches(files):
+            self._cur.executemany(_SQL_UPSERT, batch)
+
     def remove_file(self, file_metadata: FileMetadata) -> None:
         """
         Removes a file from the database, based on path in given
@@ -157,16 +402,38 @@ class FileMetadataDb:
         if not isinstance(file_metadata, FileMetadata):
             raise TypeError("File given isn't a FileMetadata object.")
 
-        cur = self._conn.cursor()
-        sql_dict = file_metadata.as_sql_dict()
-        cur.execute("DELETE FROM files WHERE path = :path", sql_dict)
-        cur.close()
-        if cur.rowcount < 1:
+        # Only the path is needed, and building the full SQL dict would look up
+        # the fs_id, which can cost a syscall.
+        self._begin_if_needed()
+        self._cur.execute(_SQL_DELETE, (file_metadata.path_str,))
+        if self._cur.rowcount < 1:
             raise FileNotFoundError(f"Deleting file failed because it doesn't exist in the database: {file_metadata.path}")
 
+    def remove_files(self, files: Iterable[FileMetadata]) -> None:
+        """
+        Removes every file in `files` from the database, all of which must
+        exist in it.
+
+        Like `add_files`, the files are removed in batches, as part of the
+        current transaction.
+
+        Raises:
+            FileNotFoundError:
+              One or more of the files don't exist in the database. Files of
+              earlier batches may already have been removed.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't remove files while in read-only mode.")
+
+        self._begin_if_needed()
+        for batch in FileMetadataDb._iter_sql_tuple_batches(files, paths_only=True):
+            self._cur.executemany(_SQL_DELETE, batch)
+            if self._cur.rowcount < len(batch):
+                raise FileNotFoundError("Deleting files failed because one or more don't exist in the database.")
+
     def get_all_files(self) -> Generator[DbFileMetadata, None, None]:
         """Returns a generator that yields every file in the database."""
-        yield from self._execute_and_yield_files("SELECT * FROM files")
+        yield from self._execute_and_yield_files(_SQL_GET_ALL)
 
     def get_files_matching_hash(self,
                                 file_hash: bytes
@@ -177,25 +444,144 @@ class FileMetadataDb:
 
         #TODO: We enforce the hash size here, but not on add_file.
         if len(file_hash) != 32:
-            raise ValueError("Hash must be exactly 32 bytes (SHA256).")
+            raise ValueError("Hash must be exactly 32 bytes (SHA256 or BLAKE3).")
 
         yield from self._execute_and_yield_files(
-            "SELECT * FROM files WHERE hash = ?",
+            _SQL_MATCHING_HASH,
             args=(file_hash,)
         )
 
+    def get_files_matching_name(self, pattern: str) -> Generator[DbFileMetadata, None, None]:
+        """
+        Finds all files in database whose file name matches the glob `pattern`.
+
+        Only the name of each file is matched, without its directory, and
+        case-sensitively (such as `"report*.pdf"`). Unlike
+        `get_files_matching_regex`, this goes through an index of file names,
+        which is fastest for patterns that don't start with a wildcard.
+        """
+        if not isinstance(pattern, str):
+            raise TypeError("Pattern must be a string.")
+
+        yield from self._execute_and_yield_files(_SQL_MATCHING_NAME, args=(pattern,))
+
     def get_files_matching_regex(self,
-                                 regex: re.Pattern
+                                 regex: str | re.Pattern
                                 ) -> Generator[DbFileMetadata, None, None]:
-        """Finds all files in database where their path matches given regex."""
-        #if not isinstance(regex, re.Pattern):
-        #    raise TypeError("Argument 'regex' must be of type re.Pattern.")
+        """
+        Finds all files in database where their path matches given regex.
+
+        Like `re.match`, the regex only has to match the start of a path. Any
+        literal text the regex starts with is used to narrow down the paths
+        to check through the primary key, so that only those paths have to go
+        through Python's `re`.
 
+        Raises:
+            ValueError:
+              A compiled `regex` was given with flags other than the defaults.
+              Use inline flags (such as `(?i)`) instead.
+        """
+        if isinstance(regex, re.Pattern):
+            if regex.flags != re.compile(regex.pattern).flags:
+                raise ValueError("Compiled regex flags aren't supported, use inline flags instead.")
+            pattern = regex.pattern
+        else:
+            pattern = regex
+
+        prefix = FileMetadataDb._literal_prefix(pattern)
+        if not prefix or prefix[-1] == chr(sys.maxunicode):
+            yield from self._execute_and_yield_files(
+                _SQL_MATCHING_REGEX,
+                args=(pattern,)
+            )
+            return
+
+        # Every path starting with `prefix` sorts in between these two.
+        # Surrogates can't be encoded, so skip straight past them.
+        next_char = ord(prefix[-1]) + 1
+        if 0xD800 <= next_char <= 0xDFFF:
+            next_char = 0xE000
+        upper_bound = prefix[:-1] + chr(next_char)
         yield from self._execute_and_yield_files(
-            "SELECT * FROM files WHERE path REGEXP ?",
-            args=(regex,)
+            _SQL_MATCHING_REGEX_RANGE,
+            args=(prefix, upper_bound, pattern)
         )
 
+    def get_metadata_index(self) -> dict[str, tuple[int, int, int]]:
+        """
+        Reads the size, mtime and fs_id of every file in the database into
+        memory at once.
+
+        A scan can then tell whether each file it finds is new or changed
+        with a dict lookup, instead of a query. This costs memory in
+        proportion to the number of files in the database, roughly 200 bytes
+        per file.
+
+        Returns:
+            A dict mapping the path of every file, as a string, to a tuple of
+            its size, mtime and fs_id.
+        """
+        cur = self._conn.cursor()
+        cur.row_factory = None
+        cur.execute("SELECT path, size, mtime, fs_id FROM files")
+        index = {path: (size, mtime, fs_id) for path, size, mtime, fs_id in FileMetadataDb._iter_rows(cur)}
+        cur.close()
+        return index
+
+    def iter_duplicate_groups(self) -> Generator[tuple[bytes, list[Path]], None, None]:
+        """
+        Finds every group of files in the database that share the same hash.
+
+        This is done with a single query over the hash index, instead of
+        calling `get_files_matching_hash` once per file.
+
+        Yields:
+            A tuple of the shared hash, and the paths of all files (two or
+            more) that have it.
+        """
+        cur = self._conn.cursor()
+        cur.execute("""
+            SELECT hash, path FROM files
+            WHERE hash IN (SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1)
+            ORDER BY hash
+        """)
+
+        rows = FileMetadataDb._iter_rows(cur)
+        for file_hash, group in itertools.groupby(rows, key=lambda row: row["hash"]):
+            yield file_hash, [Path(row["path"]) for row in group]
+
+        cur.close()
+
+    @contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        """
+        Groups every change made inside a `with` block into one transaction.
+
+        The transaction is started with `BEGIN IMMEDIATE`, so the write lock
+        is taken up front, rather than on the first change. It is committed
+        when the block exits normally, and rolled back if it raises. Long
+        bulk changes, such as scanning a filesystem, should be made inside
+        one of these.
+
+        Raises:
+            RuntimeError:
+              The database is read-only, or there are already uncommitted
+              changes.
+        """
+        if self._readonly:
+            raise RuntimeError("Can't start a transaction while in read-only mode.")
+        if self._conn.in_transaction:
+            raise RuntimeError("Can't start a transaction while there are uncommitted changes.")
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.rollback()
+            raise
+        else:
+            self._conn.commit()
+
     def commit(self) -> None:
         """Commits all changes to database."""
         self._conn.commit()
@@ -207,7 +593,8 @@ class FileMetadataDb:
 
         if self._conn.in_transaction:
             print("WARNING: Closing database with unsaved transactions.", file=sys.stderr)
-        self._conn.close()
+        self._cur.close()
+        self._finalizer()
         self._is_closed = True
 
     def _execute_and_yield_files(self,
@@ -217,7 +604,8 @@ class FileMetadataDb:
         """
         Helper function used to execute given `query`, and yield all files
         returned as `DbFileMetadata` objects.
-        NOTE: This function only allows queries that begin with `SELECT *`.
+        NOTE: This function only allows queries that begin with
+        `SELECT path, hash, size, mtime, fs_id` (see `_FILE_COLUMNS`).
 
         Args:
             query: SQL query to execute on this database.
@@ -235,42 +623,137 @@ class FileMetadataDb:
         # This isn't foolproof, but it's a good start to preventing
         # queries that could modify the database from being used with this
         # function. In addition, we must ensure that the query selects all
-        # columns of the matching files, because if we are missing any
-        # properties than when we convert it to a `DbFileMetadata` object
-        # we will cause an exception.
-        if not query.lower().startswith("select * "):
-            raise ValueError("Query must begin with `SELECT * `.")
+        # columns of the matching files, in the right order, because each row
+        # is unpacked positionally into a `DbFileMetadata` object.
+        if not query.lower().startswith(f"select {_FILE_COLUMNS} "):
+            raise ValueError(f"Query must begin with `SELECT {_FILE_COLUMNS} `.")
 
         cur = self._conn.cursor()
+        # Plain tuples are much cheaper to build than `sqlite3.Row` objects.
+        cur.row_factory = None
         if args is not None:
             cur.execute(query, args)
         else:
             cur.execute(query)
 
-        file: sqlite3.Row
-        for file in cur:
-            yield DbFileMetadata(file)
+        # Only shared between the files of this query, see `from_sql_tuple`.
+        shared = SharedRowValues()
+        for file in FileMetadataDb._iter_rows(cur):
+            yield DbFileMetadata.from_sql_tuple(file, shared)
 
         cur.close()
 
-    def _bootstrap_new_db(self, db_path: Path) -> Connection:
+    @staticmethod
+    def _iter_rows(cur: sqlite3.Cursor) -> Generator[Any, None, None]:
+        """
+        Yields every row of the query last executed on `cur`.
+
+        Rows are fetched `_FETCH_SIZE` at a time, which saves a round trip into
+        sqlite per row compared to iterating over `cur` directly.
+        """
+        cur.arraysize = _FETCH_SIZE
+        rows: list
+        while rows := cur.fetchmany():
+            yield from rows
+
+    def _begin_if_needed(self) -> None:
+        """
+        Opens a transaction for the changes about to be made, unless one is
+        already open.
+
+        The connection runs in autocommit mode, so that sqlite3 never starts
+        or ends transactions behind our back, which means writes have to
+        open their own.
+        """
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN IMMEDIATE")
+
+    def _fetch_one(self, query: str, args: tuple) -> Optional[tuple]:
+        """
+        Runs `query` on the shared cursor, and returns its only row, if any.
+
+        The query is stepped to completion, rather than left open after the
+        first row, so the shared cursor never holds a read transaction open in
+        between calls.
+        """
+        rows = self._cur.execute(query, args).fetchall()
+        return rows[0] if rows else None
+
+    @staticmethod
+    def _iter_sql_tuple_batches(files: Iterable[FileMetadata],
+                                paths_only: bool=False
+                               ) -> Generator[list[tuple], None, None]:
+        """
+        Yields the SQL tuples, including the hash, of every file in `files`, in
+        lists of up to `_WRITE_BATCH_SIZE`. With `paths_only`, each tuple only
+        holds the path instead, which saves looking up the fs_id.
+        """
+        # Files are validated and converted in the same pass.
+        batch = []
+        for file_metadata in files:
+            if not isinstance(file_metadata, FileMetadata):
+                raise TypeError("File given isn't a FileMetadata object.")
+            if paths_only:
+                batch.append((file_metadata.path_str,))
+            else:
+                batch.append(file_metadata.as_sql_tuple(include_hash=True))
+            if len(batch) >= _WRITE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _tune_connection(conn: Connection, readonly: bool) -> None:
+        """
+        Configures a connection for large scans and bulk writes.
+
+        The larger page cache and memory map keep lookups during a scan from
+        going back to disk. Writable connections also switch to WAL with
+        `synchronous=NORMAL`, which only syncs at checkpoints instead of on
+        every commit. Those change the database file itself, so they are
+        skipped on read-only connections.
+        """
+        conn.executescript("""
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=1073741824;
+            PRAGMA cache_size=-65536;
+        """)
+        if not readonly:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+            """)
+
+    def _bootstrap_new_db(self, db_path: Path, hash_algorithm: str) -> Connection:
         if self._readonly:
             raise ValueError("Can't create a new database while in read-only mode.")
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: '{hash_algorithm}'.")
         if db_path.exists():
             raise FileExistsError("Database path given already exists. Won't clobber.")
 
         # Setup the required tables for the script to work.
 
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, isolation_level=None, cached_statements=_STATEMENT_CACHE_SIZE)
+        # Long paths fit fewer rows per page, so larger pages keep the tree
+        # shallow and make full scans read in larger chunks. This only takes
+        # effect before the first table is created. An existing database can
+        # be converted once, outside of WAL mode, with:
+        #   PRAGMA journal_mode=DELETE; PRAGMA page_size=65536; VACUUM;
+        conn.execute("PRAGMA page_size=65536;")
+        conn.execute("BEGIN")
+        conn.execute(_SQL_CREATE_FILES.format(table="files"))
+        for statement in _SQL_CREATE_INDEXES:
+            conn.execute(statement)
         conn.execute("""
-            CREATE TABLE files (
-                path text primary key not null,
-                hash blob not null,
-                size int not null,
-                mtime int not null,
-                fs_id int not null
+            CREATE TABLE settings (
+                key text primary key not null,
+                value text not null
             );
         """)
+        conn.execute("INSERT INTO settings (key, value) VALUES ('hash_algorithm', ?)", (hash_algorithm,))
+        conn.execute(f"PRAGMA user_version={_SCHEMA_VERSION};")
         conn.commit()
         return conn
 
@@ -280,7 +763,89 @@ class FileMetadataDb:
         uri = db_path.as_uri()
         if self._readonly:
             uri += "?mode=ro"
-        return sqlite3.connect(uri, uri=True)
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None, cached_statements=_STATEMENT_CACHE_SIZE)
+
+        if not self._readonly:
+            self._migrate(conn)
+        return conn
+
+    @staticmethod
+    def _migrate(conn: Connection) -> None:
+        """
+        Brings the schema of a database created by an older version up to date.
+
+        The schema version is kept in `PRAGMA user_version`, so each migration
+        only ever runs once, instead of being checked on every open.
+        """
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return
+
+        conn.execute("BEGIN")
+        if version < 1:
+            # Databases created before the hash index existed need it added.
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files(hash);")
+        if version < 2:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_files_name ON files({_SQL_FILE_NAME});")
+        if version < 3 and not FileMetadataDb._is_without_rowid(conn):
+            # Older databases stored files in a rowid table. They are rebuilt,
+            # so that every database has the same layout. Dropping the old
+            # table drops its indexes as well, so those are recreated.
+            conn.execute(_SQL_CREATE_FILES.format(table="files_new"))
+            conn.execute("INSERT INTO files_new (path, hash, size, mtime, fs_id) SELECT path, hash, size, mtime, fs_id FROM files")
+            conn.execute("DROP TABLE files")
+            conn.execute("ALTER TABLE files_new RENAME TO files")
+            for statement in _SQL_CREATE_INDEXES:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version={_SCHEMA_VERSION};")
+        conn.commit()
+
+    @staticmethod
+    def _is_without_rowid(conn: Connection) -> bool:
+        """Returns whether the `files` table is stored `WITHOUT ROWID`."""
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()[0]
+        return "WITHOUT ROWID" in sql.upper()
+
+    @staticmethod
+    def _read_hash_algorithm(conn: Connection) -> str:
+        """
+        Returns the hash algorithm the database was created with. Databases
+        from before it could be chosen have no settings table, and always
+        used SHA256.
+        """
+        has_settings = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'settings'"
+        ).fetchone()
+        if has_settings is None:
+            return "sha256"
+
+        result = conn.execute("SELECT value FROM settings WHERE key = 'hash_algorithm'").fetchone()
+        return "sha256" if result is None else result[0]
+
+    @staticmethod
+    def _literal_prefix(regex: str) -> str:
+        """
+        Returns the literal text every string matched by `regex` (with
+        `re.match`) starts with. This errs on the side of returning less, and
+        returns an empty string for anything complicated, such as alternations
+        or escapes.
+        """
+        # Inline flags like `(?i)` change how the whole pattern matches, even
+        # the part before them, as do other extensions like lookbehinds.
+        if "|" in regex or "(?" in regex:
+            return ""
+
+        prefix: list[str] = []
+        for i, char in enumerate(regex):
+            if i == 0 and char == "^":
+                continue
+            if char in _REGEX_SPECIAL_CHARS:
+                # A quantifier makes the character before it optional.
+                if char in "*?{" and prefix:
+                    prefix.pop()
+                break
+            prefix.append(char)
+        return "".join(prefix)
 
     @staticmethod
     def _sql_regex(regex: str, item: str) -> bool:
@@ -290,7 +855,7 @@ class FileMetadataDb:
         if not isinstance(item, str):
             raise TypeError("Regex must be applied to a string.")
         try:
-            return re.match(regex, item) is not None
+            return _compile_regex(regex).match(item) is not None
         except re.error as err:
             raise ValueError("Regex given to SQL query is invalid.")
 
@@ -299,6 +864,11 @@ class FileMetadataDb:
         """The path the database is stored at."""
         return str(self._db_path)
 
+    @property
+    def hash_algorithm(self) -> str:
+        """The algorithm every hash in the database is computed with."""
+        return self._hash_algorithm
+
     @property
     def readonly(self) -> bool:
         """Whether the database is in readonly mode."""
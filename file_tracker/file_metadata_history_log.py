@@ -4,41 +4,72 @@ Logs file changes, and the reasons behind them.
 Attributes:
     LOG_ACTIONS:
       A dict, where each key is a valid action that can be done to a file. Each
-      key's value is a list representing valid reasons for that action to be
-      done. For example, the action "update" can have the reason "changed".
+      key's value is a frozenset representing valid reasons for that action to
+      be done. For example, the action "update" can have the reason "changed".
+    COMPRESSION_EXTENSIONS:
+      A dict mapping each supported compression of the log to the file
+      extension logs compressed with it should have.
 """
 
 from pathlib import Path
-import csv
+from typing import Optional
 import gzip
+import io
+import warnings
 from file_tracker.file_metadata import FileMetadata
 
-_CSV_HEADER = ["action", "reason", "path", "new_hash"]
+try:
+    import zstandard # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None
 
-# This dict maps log actions to reason lists
+_CSV_HEADER = ["action", "reason", "path", "new_hash"]
+# Rows are written in the same format as `csv.writer`'s default dialect.
+_CSV_LINE_TERMINATOR = "\r\n"
+# Fields containing any of these have to be quoted.
+_CSV_SPECIAL_CHARS = frozenset(',"\r\n')
+
+COMPRESSION_EXTENSIONS = {
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+    "none": ".csv"
+}
+DEFAULT_COMPRESSION = "gzip"
+# Writing the log shouldn't be what slows a scan down, so favor speed over
+# compression ratio.
+_GZIP_LEVEL = 1
+_ZSTD_LEVEL = 1
+# Rows are collected until there are this many bytes of them, so the
+# compressor gets larger chunks to work on than a single row at a time.
+_FLUSH_SIZE = 65536
+
+# This dict maps log actions to reason sets
 LOG_ACTIONS = {
-    "new": [
+    "new": frozenset({
         "new_file" # When a new file is found that isn't in the database
-    ],
+    }),
 
-    "update": [
+    "update": frozenset({
         "changed" # File is suspected to have been changed
-    ],
+    }),
 
-    "delete": [
+    "delete": frozenset({
         "nonexistent", # File from database couldn't be found on disk
         "invalid_fs_id" # File from database is in a fsid no longer being tracked
-    ],
+    }),
 
-    "skip": [
+    "skip": frozenset({
         "unchanged" # File doesn't appear to have been changed
-    ],
+    }),
 
-    "error": [
+    "error": frozenset({
         "unexpected_fs_id" # File inside of registered filesystem doesn't match expected fsid
-    ]
+    })
 }
 
+# Actions that log the file's new hash.
+_HASH_ACTIONS = frozenset({"new", "update"})
+
 # "skip", "unexpected_fsid", path
 # "new", "new_file", path, new_hash
 # "updated", "changed", path, new_hash
@@ -55,7 +86,9 @@ class FileMetadataHistoryLog:
     """
     def __init__(self,
                  log_path: Path,
-                 gzip_compress: bool=True
+                 gzip_compress: Optional[bool]=None,
+                 *,
+                 compression: Optional[str]=None
                 ) -> None:
         """
         Creates a file metadata history logger.
@@ -64,17 +97,37 @@ class FileMetadataHistoryLog:
             log_path:
               `Path` of where to save log.
             gzip_compress:
-              Whether to compress log file with gzip.
+              Deprecated, use `compression` instead. Whether to compress log
+              file with gzip, same as a `compression` of "gzip" or "none".
+            compression:
+              How to compress the log file. One of the keys of
+              `COMPRESSION_EXTENSIONS`, `DEFAULT_COMPRESSION` if not given.
+              Note that "zstd" requires the `zstandard` package to be
+              installed.
 
         Raises:
             TypeError:
-              `log_path` isn't a `Path` object.
+              `log_path` isn't a `Path` object, or both `gzip_compress` and
+              `compression` were given.
+            ValueError:
+              The `compression` given is unsupported.
             FileExistsError:
               A file already exists at `log_path`.
 
         """
         if not isinstance(log_path, Path):
             raise TypeError("log_path must be a Path object.")
+        if gzip_compress is not None:
+            if compression is not None:
+                raise TypeError("Only one of gzip_compress and compression can be given.")
+            warnings.warn("gzip_compress is deprecated, use compression instead.", DeprecationWarning, stacklevel=2)
+            compression = "gzip" if gzip_compress else "none"
+        elif compression is None:
+            compression = DEFAULT_COMPRESSION
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Unsupported log compression: '{compression}'.")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("Log compression 'zstd' requires the 'zstandard' package to be installed.")
 
         self._log_path = log_path
         self._closed = False
@@ -82,13 +135,18 @@ class FileMetadataHistoryLog:
         if self._log_path.exists():
             raise FileExistsError(f"Can't create a new log at '{self._log_path}': File already exists.")
 
-        if gzip_compress:
-            self._fd = gzip.open(self._log_path, mode="xt", encoding="utf8", newline="")
+        # Lines are assembled and encoded by hand, which is a lot faster than
+        # going through `csv` and a text wrapper for every row.
+        self._fd: io.BufferedIOBase
+        if compression == "gzip":
+            self._fd = gzip.open(self._log_path, mode="xb", compresslevel=_GZIP_LEVEL)
+        elif compression == "zstd":
+            compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL, threads=-1)
+            self._fd = compressor.stream_writer(self._log_path.open(mode="xb"))
         else:
-            self._fd = self._log_path.open(mode="xt", encoding="utf8", newline="")
+            self._fd = self._log_path.open(mode="xb")
 
-        self._csv_writer = csv.DictWriter(self._fd, fieldnames=_CSV_HEADER)
-        self._csv_writer.writeheader()
+        self._buffer = bytearray((",".join(_CSV_HEADER) + _CSV_LINE_TERMINATOR).encode("utf8"))
 
     def __enter__(self) -> "FileMetadataHistoryLog":
         return self
@@ -105,8 +163,8 @@ class FileMetadataHistoryLog:
               The action that should be logged. Valid actions are stored in the
               module's LOG_ACTIONS attribute.
             reason:
-              The reason the action was performed. Valid reasons are stored as
-              in a list on the module's corresponding LOG_ACTIONS attribute.
+              The reason the action was performed. Valid reasons are stored in
+              a frozenset on the module's corresponding LOG_ACTIONS attribute.
             file:
               A `FileMetadata` object representing the file this log entry
               applies to.
@@ -118,28 +176,46 @@ class FileMetadataHistoryLog:
         if self._closed:
             raise ValueError("Can't write new log entry: log has been closed.")
 
-        if not action in LOG_ACTIONS:
+        valid_reasons = LOG_ACTIONS.get(action)
+        if valid_reasons is None:
             raise ValueError(f"Invalid log action: {action}")
-        if not reason in LOG_ACTIONS[action]:
+        if reason not in valid_reasons:
             raise ValueError(f"Invalid log reason '{reason}' for action '{action}'")
         if not isinstance(file, FileMetadata):
             raise TypeError("File argument must be a FileMetadata object.")
 
-        csv_dict = {
-            "action": action,
-            "reason": reason,
-            "path": str(file.path)
-        }
+        if action in _HASH_ACTIONS:
+            new_hash = file.hash_hex
+        else:
+            new_hash = ""
+
+        # Actions, reasons and hashes never need quoting, only paths might.
+        line = f"{action},{reason},{_quote_csv_field(file.path_str)},{new_hash}{_CSV_LINE_TERMINATOR}"
+        self._buffer += line.encode("utf8")
+        if len(self._buffer) >= _FLUSH_SIZE:
+            self.flush()
 
-        if action == "new" or action == "update":
-            csv_dict["new_hash"] = file.hash.hex()
+    def flush(self) -> None:
+        """Writes all buffered log entries to the log file."""
+        if self._closed:
+            raise ValueError("Can't flush log: log has been closed.")
 
-        self._csv_writer.writerow(csv_dict)
+        self._fd.write(self._buffer)
+        self._buffer.clear()
 
     def close(self) -> None:
         """Closes log file."""
         if self._closed:
             return
 
-        self._fd.close()
-        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._fd.close()
+            self._closed = True
+
+def _quote_csv_field(field: str) -> str:
+    """Quotes `field` the way `csv.writer` would, if it needs to be."""
+    if _CSV_SPECIAL_CHARS.isdisjoint(field):
+        return field
+    return '"' + field.replace('"', '""') + '"'
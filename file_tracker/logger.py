@@ -6,6 +6,10 @@ from pathlib import Path
 import time
 import sys
 from traceback import format_exception
+from typing import Optional
+
+# Entries are small, so buffer plenty of them before writing to disk.
+_BUFFER_SIZE = 65536
 
 class Logger:
     """
@@ -24,7 +28,8 @@ class Logger:
     def __init__(self,
                  log_file: Path,
                  log_exception: bool=True,
-                 mirror_to_stdout: bool=False
+                 mirror_to_stdout: bool=False,
+                 flush_every: Optional[int]=None
                 ) -> None:
         """
         Inits a Logger for the given `log_file`.
@@ -39,22 +44,32 @@ class Logger:
             mirror_to_stdout:
               If `True`, writes all log entries to sys.stdout in addition to the
               usual log file.
+            flush_every:
+              If given, the log file is flushed after this many log entries.
+              Otherwise, entries are only written out once the buffer fills
+              up, and when the log is closed.
 
         Raises:
             FileExistsError:
               The `log_file` given already exists.
+            ValueError:
+              `flush_every` is less than 1.
         """
         if not isinstance(log_file, Path):
             raise TypeError("Log file must be of type path.")
+        if flush_every is not None and flush_every < 1:
+            raise ValueError("flush_every must be at least 1.")
         if log_file.exists():
             raise FileExistsError(f"Log file path already exists. Won't clobber. {log_file}")
 
         self._mirror_to_stdout = bool(mirror_to_stdout)
         self._log_exception = bool(log_exception)
         self._closed = False
+        self._flush_every = flush_every
+        self._entries_since_flush = 0
 
-        self._fd = log_file.open(mode="xt", encoding="utf8")
-        self._fd.write(f"[{get_time()}] START OF LOG\n")
+        self._fd = log_file.open(mode="xt", encoding="utf8", buffering=_BUFFER_SIZE)
+        self._fd.write("[" + get_time() + "] START OF LOG\n")
 
     def __enter__(self) -> "Logger":
         return self
@@ -75,9 +90,24 @@ class Logger:
         if self._closed:
             raise ValueError("Can't write to log because it is already closed.")
 
-        self._fd.write(f"[{get_time()}] {text}")
+        # Built once, so that stdout gets the same timestamped entry as the file.
+        line = "[" + get_time() + "] " + text
+        self._fd.write(line)
         if self._mirror_to_stdout or mirror_to_stdout:
-            sys.stdout.write(text)
+            sys.stdout.write(line)
+
+        if self._flush_every is not None:
+            self._entries_since_flush += 1
+            if self._entries_since_flush >= self._flush_every:
+                self.flush()
+
+    def flush(self) -> None:
+        """Writes all buffered log entries to disk."""
+        if self._closed:
+            raise ValueError("Can't flush log because it is already closed.")
+
+        self._fd.flush()
+        self._entries_since_flush = 0
 
     @property
     def mirror_to_stdout(self) -> bool:
@@ -125,10 +155,29 @@ class Logger:
         if self._closed:
             return
 
-        self._fd.write(f"[{get_time()}] END OF LOG\n")
+        self._fd.write("[" + get_time() + "] END OF LOG\n")
         self._fd.close()
         self._closed = True
 
+class _TimeCache:
+    """
+    Holds the last formatted time, along with the second it was formatted
+    for. Log entries tend to come in bursts, so the formatted time is only
+    recomputed once the second changes.
+    """
+    __slots__ = ("last",)
+
+    def __init__(self) -> None:
+        # Replaced as a whole, so it is never seen half updated.
+        self.last: tuple[int, str] = (-1, "")
+
+_time_cache = _TimeCache()
+
 def get_time() -> str:
     """Returns the current time in a nicely formatted string."""
-    return time.strftime("%Y-%m-%d %H:%M:%S")
+    second = int(time.time())
+    last_second, time_str = _time_cache.last
+    if second != last_second:
+        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _time_cache.last = (second, time_str)
+    return time_str
@@ -8,33 +8,39 @@ filesystems to track, and the path to the file metadata database.
 from argparse import ArgumentParser
 from pathlib import Path
 import time
-from math import floor
 import json
 import os
+from file_tracker.file_metadata import DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS
 from file_tracker.file_metadata_db import FileMetadataDb
+from file_tracker.file_metadata_history_log import COMPRESSION_EXTENSIONS
 from file_tracker import utils
 
 # Should this database track the inode of each file, therefore allowing detection of hardlinks pointing to the same file?
 
-arg_parser = ArgumentParser(
-                                description="Updates config for file metadata tracker."
-                           )
-arg_parser.add_argument("config_file", type=Path, help="Path to config file")
-arg_parser.add_argument("--new", action="store_true", help="Create new config file. When using this parameter, you are required to specify at least on filesystem to track.")
+def main():
+    arg_parser = ArgumentParser(description="Updates config for file metadata tracker.")
+    arg_parser.add_argument("config_file", type=Path, help="Path to config file")
+    arg_parser.add_argument("--new", action="store_true", help="Create new config file. When using this parameter, you are required to specify at least on filesystem to track.")
 
-arg_parser.add_argument("--database-path", type=Path, help="File metadata database.")
-arg_parser.add_argument("--log-folder", type=Path, help="A folder to hold database logs.")
+    arg_parser.add_argument("--database-path", type=Path, help="File metadata database.")
+    arg_parser.add_argument("--log-folder", type=Path, help="A folder to hold database logs.")
+    arg_parser.add_argument("--hash-algorithm", choices=sorted(HASH_ALGORITHMS), help=f"Algorithm to hash files with when creating a new database. Defaults to {DEFAULT_HASH_ALGORITHM}.")
 
-arg_parser.add_argument("--register-fs", action="append", type=Path, help="Add a new filesystem to track.")
-arg_parser.add_argument("--delete-fs", action="append", type=Path, help="Delete filesystem from tracking.")
+    arg_parser.add_argument("--history-compression", choices=sorted(COMPRESSION_EXTENSIONS), help="How to compress file history logs.")
+    arg_parser.add_argument("--walker-threads", type=int, help="How many threads to walk filesystems with. Defaults to 1.")
 
-args = arg_parser.parse_args()
+    arg_parser.add_argument("--register-fs", action="append", type=Path, help="Add a new filesystem to track.")
+    arg_parser.add_argument("--delete-fs", action="append", type=Path, help="Delete filesystem from tracking.")
+
+    args = arg_parser.parse_args()
 
-def main():
     config_file = args.config_file
     create_new_config = args.new
     new_db_path = args.database_path
     new_log_folder = args.log_folder
+    hash_algorithm = args.hash_algorithm
+    history_compression = args.history_compression
+    walker_threads = args.walker_threads
     add_fs = args.register_fs
     remove_fs = args.delete_fs
 
@@ -57,11 +63,23 @@ def main():
         remove_filesystems(current_config, remove_fs)
 
     if new_db_path:
-        update_database_path(current_config, new_db_path)
+        update_database_path(current_config, new_db_path, hash_algorithm)
+    elif hash_algorithm:
+        print("WARNING: A hash algorithm can only be chosen when creating a new database. Ignoring...")
 
     if new_log_folder:
         update_log_folder(current_config, new_log_folder)
 
+    if history_compression:
+        print("Updating history log compression...")
+        current_config["history_compression"] = history_compression
+
+    if walker_threads is not None:
+        print("Updating walker threads...")
+        if walker_threads < 1:
+            raise ValueError("Walker threads must be at least 1.")
+        current_config["walker_threads"] = walker_threads
+
     current_config["config_last_changed"] = current_time()
     write_config(current_config, config_file)
 
@@ -96,10 +114,16 @@ def remove_filesystems(config: dict, remove_fs: list[Path]) -> None:
         else:
             print(f"Warning: Filesystem '{fs}' wasn't found in the config. Ignoring...")
 
-def update_database_path(config: dict, database_path: Path) -> None:
+def update_database_path(config: dict,
+                         database_path: Path,
+                         hash_algorithm: str | None=None
+                        ) -> None:
     """
     Change the path to the file metadata database
 
+    If no database exists at `database_path` yet, one is created that hashes
+    files with `hash_algorithm`.
+
     Raises:
         ValueError:
           The `database_path` given points to something other than a file, or
@@ -111,7 +135,9 @@ def update_database_path(config: dict, database_path: Path) -> None:
         raise ValueError("New database doesn't point to a file.")
 
     if not database_path.exists():
-        create_new_database(database_path)
+        create_new_database(database_path, hash_algorithm or DEFAULT_HASH_ALGORITHM)
+    elif hash_algorithm:
+        print("WARNING: Database already exists, so its hash algorithm can't be changed. Ignoring...")
 
     if not utils.is_sqlite_db(database_path):
         raise ValueError("New database path points to a non-database file.")
@@ -149,10 +175,21 @@ def read_config(config_file: Path) -> dict:
         return config
 
 def write_config(config: dict, config_file: Path) -> None:
-    """Dumps the given config file to a string, and writes it to disk."""
+    """
+    Dumps the given config file to a string, and writes it to disk.
+
+    The config is written to a temporary file next to `config_file` first,
+    which then replaces it. A crash part way through leaves the old config
+    intact, instead of a truncated one.
+    """
     print("Writing new config...")
-    with config_file.open(mode="wt") as f:
-        json.dump(config, f, indent=4)
+    config_str = json.dumps(config, indent=4)
+    temp_file = config_file.with_name(config_file.name + ".tmp")
+    with temp_file.open(mode="wt") as f:
+        f.write(config_str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, config_file)
     print("Done!")
 
 def create_config_template() -> dict:
@@ -166,14 +203,17 @@ def create_config_template() -> dict:
 
 def current_time() -> int:
     """Returns the current time in milliseconds."""
-    return floor(time.time() * 1000)
+    return time.time_ns() // 1_000_000
 
-def create_new_database(database_path: Path) -> None:
+def create_new_database(database_path: Path,
+                        hash_algorithm: str=DEFAULT_HASH_ALGORITHM
+                       ) -> None:
     """Create a new, empty `FileMetadataDb`."""
     print("Creating new database...")
     # Creates new database, and closes it after it initializes itself.
-    with FileMetadataDb(database_path, readonly=False, create_new_db=True) as db:
+    with FileMetadataDb(database_path, readonly=False, create_new_db=True, hash_algorithm=hash_algorithm) as db:
         db.close()
     print("Done creating database.")
 
-main()
+if __name__ == "__main__":
+    main()
@@ -3,29 +3,36 @@ This script iterates throughout a filesystem/directory based upon the given
 config, and updates a corresponding database with file metadata.
 """
 
+import functools
+import io
 import json
+import os
+import sys
 import time
 from argparse import ArgumentParser
+from collections import Counter
 from pathlib import Path
+from typing import Iterable
 
 from file_tracker.logger import Logger
 import file_tracker.utils as utils
-from file_tracker.file_metadata import FileMetadata
+from file_tracker.file_metadata import FileMetadata, hash_many
 from file_tracker.file_metadata_db import FileMetadataDb
-from file_tracker.file_metadata_history_log import FileMetadataHistoryLog
-
-arg_parser = ArgumentParser(
-                                description="Scans filesystem and updates file metadata database."
-                           )
-arg_parser.add_argument("config_file", type=Path, help="Path to config file.")
-
-args = arg_parser.parse_args()
-
-files_added = 0
-files_updated = 0
-files_skipped = 0
-files_deleted = 0
-files_error = 0
+from file_tracker.file_metadata_history_log import (
+    COMPRESSION_EXTENSIONS,
+    DEFAULT_COMPRESSION,
+    LOG_ACTIONS,
+    FileMetadataHistoryLog
+)
+
+# How many scanned files to compare against the database at once.
+SCAN_BATCH_SIZE = 1000
+# How many file changes to write before committing them, so that a crash part
+# way through a long scan doesn't lose everything written so far.
+COMMIT_EVERY = 50000
+# What each change printed by `log_change` starts with, built once per action
+# rather than once per file.
+_CHANGE_PREFIXES = {action: action.upper() + ": " for action in LOG_ACTIONS}
 
 """
 Using Path.rglob doesn't throw errors when it encounters
@@ -38,45 +45,70 @@ and ensure that I have read access to it
 """
 
 def main():
+    arg_parser = ArgumentParser(description="Scans filesystem and updates file metadata database.")
+    arg_parser.add_argument("config_file", type=Path, help="Path to config file.")
+
+    args = arg_parser.parse_args()
+
     config_file = args.config_file
     config = read_config(config_file)
     db_path = config["db_path"]
     log_folder = config["log_folder"]
     filesystems = config["filesystems"]
+    history_compression = config["history_compression"]
+    walker_threads = config["walker_threads"]
 
-    log_paths = create_log_file_paths(log_folder)
+    log_paths = create_log_file_paths(log_folder, history_compression)
     log_file = log_paths["log"]
     history_csv_file = log_paths["csv"]
 
+    # Every file scanned prints a line, so don't flush stdout after each one
+    # when it is a terminal. Log entries mirrored to stdout go through the
+    # same buffer, so everything still comes out in order.
+    if isinstance(sys.stdout, io.TextIOWrapper):
+        sys.stdout.reconfigure(line_buffering=False)
+
+    # Counts the files "added", "updated", "deleted", "skipped" and "error",
+    # as well as the changes not committed yet, as "uncommitted".
+    stats: Counter[str] = Counter()
+
     with Logger(log_file, mirror_to_stdout=False) as log:
-        with FileMetadataHistoryLog(history_csv_file) as history:
+        with FileMetadataHistoryLog(history_csv_file, compression=history_compression) as history:
             with FileMetadataDb(db_path, readonly=False) as db:
-                prune_deleted_files(db, filesystems, log, history)
-                register_new_files(db, filesystems, log, history)
-
-                # Want the following lines to be printed to the console as well as logged.
-                log.mirror_to_stdout = True
-                log.log("Finished updating database. Committing changes...")
-                db.commit()
+                # The scan is written in as few transactions as possible,
+                # see `record_changes`.
+                with db.transaction():
+                    # Files are popped off as they are scanned, which leaves
+                    # only the ones that may have been deleted.
+                    db_index = db.get_metadata_index()
+                    register_new_files(db, db_index, filesystems, log, history, stats, walker_threads)
+                    prune_deleted_files(db, db_index, filesystems, log, history, stats)
+
+                    # Want the following lines to be printed to the console as well as logged.
+                    log.mirror_to_stdout = True
+                    log.log("Finished updating database. Committing changes...")
                 log.log("Successfully commited changes to database.")
             
             log.log("Closing file history log...")
         log.log("Sucessfully closed file history log.")
 
-        log.log(f"Files added: {files_added}")
-        log.log(f"Files updated: {files_updated}")
-        log.log(f"Files deleted: {files_deleted}")
-        log.log(f"Files skipped: {files_skipped}")
-        log.log(f"File errors: {files_error}")
+        log.log(f"Files added: {stats['added']}")
+        log.log(f"Files updated: {stats['updated']}")
+        log.log(f"Files deleted: {stats['deleted']}")
+        log.log(f"Files skipped: {stats['skipped']}")
+        log.log(f"File errors: {stats['error']}")
 
-        if files_error != 0:
-            log.warn(f"{files_error} FILE ERRORS OCCURED WHILE UPDATING DATABASE.")
+        if stats["error"] != 0:
+            log.warn(f"{stats['error']} FILE ERRORS OCCURED WHILE UPDATING DATABASE.")
 
 
 def register_new_files(db: FileMetadataDb,
+                       db_index: dict[str, tuple[int, int, int]],
                        filesystems: dict[str, int],
                        log: Logger,
-                       history: FileMetadataHistoryLog
+                       history: FileMetadataHistoryLog,
+                       stats: Counter[str],
+                       walker_threads: int=1
                       ) -> None:
     """
     Iterate over all files in `filesystems` and adds/updates them in the `db`.
@@ -84,6 +116,9 @@ def register_new_files(db: FileMetadataDb,
     Arguments:
         db:
           The `FileMetadataDb` to update with new metadata.
+        db_index:
+          The `FileMetadataDb.get_metadata_index` of the `db`, from before
+          the scan started. Every file scanned is popped off of it.
         filesystems:
           A dict of keys where each key is a string representing a
           filesystem/directory, and each value corresponds to that filesystems
@@ -93,58 +128,149 @@ def register_new_files(db: FileMetadataDb,
           updated files, or skipped files.
         history:
           A `FileMetadataHistoryLog` object to log all file changes to.
+        stats:
+          A `Counter` of what happened to the files scanned, see `main`.
+        walker_threads:
+          How many threads to walk each filesystem with. With more than one,
+          `utils.walk_files_parallel` is used.
     """
-    global files_added, files_skipped, files_updated, files_error
-    for fs in filesystems:
+    error_handler = functools.partial(log_permission_error, log, stats)
+    for fs, fs_id in filesystems.items():
         log.log(f"Iterating over filesystem '{fs}'...", mirror_to_stdout=True)
-        for file in utils.walk_files(fs, lambda err: log_permission_error(log, err)):
-            # `file` could be a block device, network socket, etc.
-            if not file.is_file():
+        # Resolved once here, so the paths walked under it are resolved too.
+        fs_path = os.path.realpath(fs)
+        batch: list[FileMetadata] = []
+        if walker_threads > 1:
+            entries = utils.walk_files_parallel(fs_path, error_handler, walker_threads)
+        else:
+            entries = utils.walk_files(fs_path, error_handler)
+
+        for entry in entries:
+            # `entry` could be a block device, network socket, symlink, etc.
+            if not entry.is_file(follow_symlinks=False):
                 continue
-            file_metadata = FileMetadata(file)
-            db_file = db.get_file(file_metadata)
+            # `fs_path` is resolved, and symlinked directories aren't walked
+            # into, so every path found is already resolved.
+            file_metadata = FileMetadata.from_dir_entry(entry, hash_algorithm=db.hash_algorithm)
 
-            if file_metadata.fs_id != filesystems[fs]:
-                log.error(f"Unexpected fsid for '{file}', fsid: '{file_metadata.fs_id}'.")
+            if file_metadata.fs_id != fs_id:
+                log.error(f"Unexpected fsid for '{file_metadata.path}', fsid: '{file_metadata.fs_id}'.")
                 log_change(history, "error", "unexpected_fs_id", file_metadata)
-                files_error += 1
+                stats["error"] += 1
+                continue
 
-            elif db_file is None:
-                try:
-                    db.add_file(file_metadata)
-                    log_change(history, "new", "new_file", file_metadata)
-                    files_added += 1
-                except PermissionError as err:
-                    log_permission_error(log, err)
+            batch.append(file_metadata)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                register_batch(db, db_index, batch, log, history, stats)
+                batch = []
+
+        register_batch(db, db_index, batch, log, history, stats)
+
+def register_batch(db: FileMetadataDb,
+                   db_index: dict[str, tuple[int, int, int]],
+                   batch: list[FileMetadata],
+                   log: Logger,
+                   history: FileMetadataHistoryLog,
+                   stats: Counter[str]
+                  ) -> None:
+    """
+    Adds/updates a batch of scanned files in the `db`.
 
-            elif has_file_changed(db_file, file_metadata):
+    The batch is compared against `db_index` in memory, so only new and
+    changed files need any further work.
+
+    Arguments:
+        db:
+          The `FileMetadataDb` to update with new metadata.
+        db_index:
+          See `register_new_files`.
+        batch:
+          A list of `FileMetadata` objects, all from tracked filesystems.
+        log:
+          A `Logger` object to write all logs to, such as errors, new files,
+          updated files, or skipped files.
+        history:
+          A `FileMetadataHistoryLog` object to log all file changes to.
+        stats:
+          See `register_new_files`.
+    """
+    new_files = set()
+    changed_files = set()
+    for file_metadata in batch:
+        path = file_metadata.path_str
+        known = db_index.pop(path, None)
+        if known is None:
+            new_files.add(path)
+        elif known != (file_metadata.size, file_metadata.mtime, file_metadata.fs_id):
+            changed_files.add(path)
+            if known[:2] == (file_metadata.size, file_metadata.mtime):
+                db_file = db.get_file(file_metadata)
+                if db_file is not None:
+                    # Saves rehashing a file whose contents are known not to
+                    # have changed, say when only its fs_id differs.
+                    file_metadata.adopt_hash_if_unchanged(db_file)
+
+    # Filesystems may overlap, in which case an earlier batch may have already
+    # popped (and written) a file that looks new here.
+    if new_files:
+        new_files -= db.does_exist_many(new_files)
+
+    to_hash = [x for x in batch if x.path_str in new_files or x.path_str in changed_files]
+
+    # Files we can't read are left unhashed here, so that the error is raised
+    # (and logged) again below, before they are written to the database.
+    hashed = hash_many(to_hash, ignore_errors=True)
+
+    # New and changed files are written together, with a single statement.
+    to_write = []
+    for file_metadata in batch:
+        path = file_metadata.path_str
+        if path in new_files or path in changed_files:
+            if path not in hashed:
                 try:
-                    db.update_file(file_metadata)
-                    log_change(history, "update", "changed", file_metadata)
-                    files_updated += 1
+                    file_metadata.hash
                 except PermissionError as err:
-                    log_permission_error(log, err)
+                    log_permission_error(log, stats, err)
+                    continue
 
+            to_write.append(file_metadata)
+            if path in new_files:
+                log_change(history, "new", "new_file", file_metadata)
+                stats["added"] += 1
             else:
-                log_change(history, "skip", "unchanged", file_metadata)
-                files_skipped += 1
+                log_change(history, "update", "changed", file_metadata)
+                stats["updated"] += 1
+
+        else:
+            log_change(history, "skip", "unchanged", file_metadata)
+            stats["skipped"] += 1
+
+    db.upsert_files(to_write)
+    record_changes(db, stats, len(to_write))
 
 
 def prune_deleted_files(db: FileMetadataDb,
+                        unscanned_files: Iterable[str],
                         filesystems: dict[str, int],
                         log: Logger,
-                        history: FileMetadataHistoryLog
+                        history: FileMetadataHistoryLog,
+                        stats: Counter[str]
                        ) -> None:
     """
     Prunes nonexistant files from the database.
 
-    Iterates over all files in the `db` and checks if they all still exist on
-    disk, and if so, checks that they are in one of the allowed filesystem IDs.
-    If either are false, it removes the file from the database.
+    Looks up only the files in the `db` that weren't found by the scan, and
+    checks if they still exist on disk, and if so, checks that they are in one
+    of the allowed filesystem IDs. If either are false, it removes the file
+    from the database. Files found by the scan are known to exist, so they
+    aren't read from the `db` at all.
 
     Arguments:
         db:
           The `FileMetadataDb` to update with new metadata.
+        unscanned_files:
+          The paths of the files in the `db` that weren't found by
+          `register_new_files`.
         filesystems:
           A dict of keys where each key is a string representing a
           filesystem/directory, and each value corresponds to that filesystems
@@ -154,24 +280,51 @@ def prune_deleted_files(db: FileMetadataDb,
           deltions.
         history:
           A `FileMetadataHistoryLog` object to log all file changes to.
+        stats:
+          See `register_new_files`.
     """
-    global files_deleted
     log.log("Pruning database of deleted files...", mirror_to_stdout=True)
-    allowed_fsids = filesystems.values()
+    allowed_fsids = frozenset(filesystems.values())
+
+    # Fetched up front, so no query is still being read from while files are
+    # removed and committed below.
+    unscanned = db.get_files_many(unscanned_files)
 
-    for file in db.get_all_files():
+    # Removed from the database in batches, like scanned files are written.
+    to_remove = []
+    for file in unscanned:
         if not file.fs_id in allowed_fsids:
-            db.remove_file(file)
+            to_remove.append(file)
             log.warn(f"Found file with invalid fs_id '{file.fs_id}': '{file.path}'. Deleting.")
             log_change(history, "delete", "invalid_fs_id", file)
-            files_deleted += 1
+            stats["deleted"] += 1
 
         elif not file.path.is_file():
-            db.remove_file(file)
+            to_remove.append(file)
             log_change(history, "delete", "nonexistent", file)
-            files_deleted += 1
+            stats["deleted"] += 1
 
-    log.log(f"Pruning complete with {files_deleted} files deleted.", mirror_to_stdout=True)
+        if len(to_remove) >= SCAN_BATCH_SIZE:
+            db.remove_files(to_remove)
+            record_changes(db, stats, len(to_remove))
+            to_remove = []
+
+    db.remove_files(to_remove)
+    record_changes(db, stats, len(to_remove))
+
+    log.log(f"Pruning complete with {stats['deleted']} files deleted.", mirror_to_stdout=True)
+
+def record_changes(db: FileMetadataDb, stats: Counter[str], count: int) -> None:
+    """
+    Keeps track of how many file changes were written to the `db`, and commits
+    them once there are at least `COMMIT_EVERY`.
+
+    The next change made opens a new transaction by itself.
+    """
+    stats["uncommitted"] += count
+    if stats["uncommitted"] >= COMMIT_EVERY:
+        db.commit()
+        stats["uncommitted"] = 0
 
 def log_change(history: FileMetadataHistoryLog,
                action: str,
@@ -195,12 +348,11 @@ def log_change(history: FileMetadataHistoryLog,
     """
 
     history.add(action, reason, file)
-    print(f"{action.upper()}: {reason}, {file.path}")
+    sys.stdout.write(_CHANGE_PREFIXES[action] + reason + ", " + file.path_str + "\n")
 
-def log_permission_error(log: Logger, err: PermissionError) -> None:
-    global files_error
+def log_permission_error(log: Logger, stats: Counter[str], err: PermissionError) -> None:
     log.error(f"Permission Error: {err}", mirror_to_stdout=True)
-    files_error += 1
+    stats["error"] += 1
 
 def validate_filesystem_mapping(filesystems: dict[str, int]) -> None:
     """
@@ -217,18 +369,6 @@ def validate_filesystem_mapping(filesystems: dict[str, int]) -> None:
         if expected_fsid != fsid:
             raise ValueError(f"fsid mismatch found in config file for filesystem {filesystem}. Expected: {expected_fsid}, actual: {fsid}.")
 
-def has_file_changed(file_metadata_1: FileMetadata,
-                     file_metadata_2: FileMetadata
-                    ) -> bool:
-    """Detects if a file changed, given two `FileMetadata` objects."""
-    if file_metadata_1.mtime != file_metadata_2.mtime:
-        return True
-    if file_metadata_1.size != file_metadata_2.size:
-        return True
-    if file_metadata_1.fs_id != file_metadata_2.fs_id:
-        return True
-    return False
-
 def read_config(config_file: Path) -> dict:
     """
     Reads and validates the given `config_file` path. Returns a dict
@@ -262,13 +402,26 @@ def read_config(config_file: Path) -> dict:
 
     validate_filesystem_mapping(filesystems)
 
+    # Older configs don't have this setting.
+    history_compression = config.get("history_compression", DEFAULT_COMPRESSION)
+    if history_compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unsupported history log compression in config file: '{history_compression}'.")
+
+    walker_threads = config.get("walker_threads", 1)
+    if not isinstance(walker_threads, int) or walker_threads < 1:
+        raise ValueError("Walker threads in config file must be a positive integer.")
+
     return {
         "db_path": db_path,
         "filesystems": filesystems,
-        "log_folder": log_folder
+        "log_folder": log_folder,
+        "history_compression": history_compression,
+        "walker_threads": walker_threads
     }
 
-def create_log_file_paths(log_folder: Path) -> dict[str, Path]:
+def create_log_file_paths(log_folder: Path,
+                          history_compression: str=DEFAULT_COMPRESSION
+                         ) -> dict[str, Path]:
     """
     Creates `Path` objects representing where to save log files to. This
     function creates unique file names based upon system time, and ensures that
@@ -279,6 +432,9 @@ def create_log_file_paths(log_folder: Path) -> dict[str, Path]:
         log_folder:
           A `Path` object representing the folder in which the log files should
           be saved.
+        history_compression:
+          How the CSV file metadata history will be compressed, which decides
+          its file extension.
 
     Returns:
         A dict with keys `log` and `csv`. Each key's value represents a unique
@@ -290,7 +446,7 @@ def create_log_file_paths(log_folder: Path) -> dict[str, Path]:
     log_file_base = log_folder / time.strftime("%Y-%m-%d %H-%M-%S")
 
     log_file = log_file_base.with_suffix(".log")
-    csv_file = log_file_base.with_suffix(".csv.gz")
+    csv_file = log_file_base.with_suffix(COMPRESSION_EXTENSIONS[history_compression])
 
     if log_file.exists() or csv_file.exists():
         raise FileExistsError("Log file already exists, won't clobber. (Did you run this script twice in one second?)")
@@ -300,4 +456,5 @@ def create_log_file_paths(log_folder: Path) -> dict[str, Path]:
         "csv": csv_file
     }
 
-main()
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
 """Common utils"""
 
+import queue
 import re
 import sys
 import os
+import threading
 from pathlib import Path
-from typing import Callable, Generator
+from typing import Callable, Generator, Optional
 
-SQL_SAFE_CHARS_REGEX = "^[A-z0-9-]{1,100}$"
+SQL_SAFE_CHARS_REGEX = re.compile("[A-Za-z0-9-]{1,100}")
+# How many scanned directories `walk_files_parallel` may get ahead of its caller.
+PARALLEL_WALK_QUEUE_SIZE = 1000
+
+# Every file on a filesystem shares its st_dev, so the fsid behind each
+# st_dev only has to be looked up once. See `get_fsid`.
+_fsid_by_dev: dict[int, int] = {}
 
 def assert_sql_safe_chars(string: str) -> None:
     """Raises an exception if given string contains SQL unsafe chars."""
     if not isinstance(string, str):
         raise TypeError("Argument isn't a string.")
-    if not re.fullmatch(SQL_SAFE_CHARS_REGEX, string):
+    if not SQL_SAFE_CHARS_REGEX.fullmatch(string):
         raise ValueError(f"Argument has unsafe characters: ${string}")
 
 def is_sqlite_db(path: Path) -> bool:
@@ -20,24 +28,37 @@ def is_sqlite_db(path: Path) -> bool:
     if not path.is_file():
         raise FileNotFoundError(f"Path given doesn't exist: {path}")
 
-    # SQLite database header is 100 bytes long.
-    if path.stat().st_size < 100:
-        return False
+    # SQLite database header is 100 bytes long, so reading all of it also
+    # tells us whether the file is long enough, without a separate stat.
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        header = os.read(fd, 100)
+    finally:
+        os.close(fd)
 
-    with path.open(mode="rb") as f:
-        header = f.read(16)
+    return len(header) == 100 and header.startswith(b"SQLite format 3\0")
 
-    if header == b"SQLite format 3\0":
-        return True
-    else:
-        return False
+def get_fsid(path: str | Path, st_dev: Optional[int]=None) -> int:
+    """
+    Gets the filesystem ID of a given path.
+
+    Arguments:
+        path:
+          The path to get the filesystem ID of.
+        st_dev:
+          The `st_dev` of `path`, if it has already been stat'd. The ID is
+          then only looked up once per device, rather than once per path.
+    """
+    if st_dev is not None:
+        fsid = _fsid_by_dev.get(st_dev)
+        if fsid is None:
+            fsid = _fsid_by_dev.setdefault(st_dev, get_fsid(path))
+        return fsid
 
-def get_fsid(path: Path) -> int:
-    """Gets the filesystem ID of a given path."""
     if sys.platform == "linux":
         return os.statvfs(path).f_fsid
     elif sys.platform == "win32":
-        return path.stat().st_dev
+        return os.stat(path).st_dev
     else:
         raise NotImplementedError(f"Unsupported platform: {sys.platform}")
 
@@ -49,8 +70,8 @@ def dump_database(path: Path) -> None:
     with FileMetadataDb(path) as db:
         for file in db.get_all_files():
             # Path, hash, size, mtime, fs_id
-            f_path = str(file.path).ljust(80)
-            f_hash = file.hash.hex()
+            f_path = file.path_str.ljust(80)
+            f_hash = file.hash_hex
             f_size = str(file.size).ljust(10)
             f_mtime = str(file.mtime).ljust(18)
             f_fs_id = str(file.fs_id).ljust(10)
@@ -59,9 +80,14 @@ def dump_database(path: Path) -> None:
 
 def walk_files(path: str | Path,
                error_handler: Callable
-              ) -> Generator[Path, None, None]:
+              ) -> Generator[os.DirEntry, None, None]:
     """
-    Simplifies `os.walk` into a function that only yields file paths.
+    Recursively yields every entry under `path` that isn't a directory.
+
+    Like `os.walk`, symlinks to directories aren't followed. Unlike it, the
+    `os.DirEntry` of each file is yielded, rather than its path, so callers can
+    use the file type and stat result it caches instead of statting the file
+    again.
 
     Arguments:
         path:
@@ -74,7 +100,136 @@ def walk_files(path: str | Path,
     if not callable(error_handler):
         raise TypeError("error_handler must be a function.")
 
-    for root, dirs, files in os.walk(path, onerror=error_handler):
-        root_path = Path(root)
-        for file in files:
-            yield root_path.joinpath(file)
+    dirs = [os.fspath(path)]
+    while dirs:
+        try:
+            scandir_it = os.scandir(dirs.pop())
+        except OSError as err:
+            error_handler(err)
+            continue
+
+        with scandir_it:
+            try:
+                for entry in scandir_it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if not is_dir:
+                        yield entry
+                    elif not entry.is_symlink():
+                        dirs.append(entry.path)
+            except OSError as err:
+                # Listing can also fail partway through a directory, say if
+                # it is removed or its filesystem goes away.
+                error_handler(err)
+
+def walk_files_parallel(path: str | Path,
+                        error_handler: Callable,
+                        workers: int=8
+                       ) -> Generator[os.DirEntry, None, None]:
+    """
+    Like `walk_files`, but directories are scanned by a pool of threads.
+
+    Walking a large tree mostly waits on `readdir` and `stat` syscalls, so
+    several threads scanning directories at once can get through it much
+    faster. Each thread also stats the files it finds, so the stat results
+    are already cached on the entries yielded. Entries are yielded, and
+    `error_handler` called, on the calling thread only, so neither has to be
+    thread-safe. Entries aren't yielded in any particular order.
+
+    Arguments:
+        path:
+          Path to walk recursively.
+        error_handler:
+          See `walk_files`.
+        workers:
+          How many threads to scan directories with.
+    """
+    if not callable(error_handler):
+        raise TypeError("error_handler must be a function.")
+    if workers < 1:
+        raise ValueError("workers must be at least 1.")
+
+    dirs: queue.Queue = queue.Queue()
+    results: queue.Queue = queue.Queue(maxsize=PARALLEL_WALK_QUEUE_SIZE)
+    # Set once the caller stops iterating, so the threads can wind down.
+    stop = threading.Event()
+    # How many directories are either queued or being scanned.
+    pending = 1
+    pending_lock = threading.Lock()
+
+    def put_result(item) -> None:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def scan_dir(directory: str) -> None:
+        nonlocal pending
+        entries = []
+        try:
+            with os.scandir(directory) as scandir_it:
+                for entry in scandir_it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if not is_dir:
+                        try:
+                            if entry.is_file(follow_symlinks=False):
+                                entry.stat(follow_symlinks=False)
+                        except OSError:
+                            # The caller gets the same error when it stats
+                            # the file itself.
+                            pass
+                        entries.append(entry)
+                    elif not entry.is_symlink():
+                        with pending_lock:
+                            pending += 1
+                        dirs.put(entry.path)
+        except OSError as err:
+            put_result(entries)
+            put_result(err)
+        except BaseException as err:
+            # Anything else is a bug rather than a filesystem error, so it is
+            # raised from the caller's thread instead of being handled.
+            put_result(err)
+        else:
+            put_result(entries)
+
+    def worker() -> None:
+        nonlocal pending
+        while (directory := dirs.get()) is not None:
+            try:
+                if not stop.is_set():
+                    scan_dir(directory)
+            finally:
+                # Always counted as done, or the walk would never finish.
+                with pending_lock:
+                    pending -= 1
+                    finished = pending == 0
+                if finished:
+                    for _ in range(workers):
+                        dirs.put(None)
+                    put_result(None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    dirs.put(os.fspath(path))
+
+    try:
+        while (item := results.get()) is not None:
+            if isinstance(item, OSError):
+                error_handler(item)
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
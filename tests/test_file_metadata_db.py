@@ -1,11 +1,13 @@
 import json
 import os
+import re
 import sqlite3
 import tempfile
 import unittest
 from pathlib import Path
 
 from file_tracker.file_metadata import DbFileMetadata
+from file_tracker import file_metadata_db
 from file_tracker.file_metadata_db import FileMetadataDb
 from tests import utils
 
@@ -60,6 +62,57 @@ class TestFileMetadataDb(unittest.TestCase):
             # db_path must be either a string or Path object.
             self.db = FileMetadataDb(123, readonly=True, create_new_db=False)
 
+    def test_migrate(self):
+        self.db_file.write_bytes(Path("tests/resources/test_file_metadata_db/common/basic_db.db").read_bytes())
+
+        # Opening an old database read-only leaves it untouched.
+        with FileMetadataDb(self.db_file) as self.db:
+            old_count = len(list(self.db.get_all_files()))
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 0)
+        conn.close()
+
+        with FileMetadataDb(self.db_file, readonly=False) as self.db:
+            pass
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 3)
+            indexes = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+            self.assertIn(("idx_files_hash",), indexes)
+            self.assertIn(("idx_files_name",), indexes)
+            # Old rowid tables are rebuilt with the same layout as new databases.
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'files'").fetchone()[0]
+            self.assertIn("WITHOUT ROWID", sql)
+            self.assertEqual(conn.execute("SELECT count(*) FROM files").fetchone()[0], old_count)
+
+        # Migrated databases can use the new indexes straight away.
+        with FileMetadataDb(self.db_file) as self.db:
+            self.assertNotEqual(list(self.db.get_files_matching_name("file*.txt")), [])
+        conn.close()
+
+    def test_schema(self):
+        self.db = self.create_new_database()
+        self.db.close()
+
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual(conn.execute("PRAGMA page_size").fetchone()[0], 65536)
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'files'").fetchone()[0]
+            self.assertIn("WITHOUT ROWID", sql)
+        conn.close()
+
+    def test_pragmas(self):
+        self.db = self.create_new_database()
+        self.assertEqual(self.db._conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(self.db._conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.db.close()
+
+        # WAL is kept in the database file, so read-only opens use it too.
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        self.assertEqual(self.db._conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        # Read-only connections still get the larger cache, so scans and
+        # lookups stay in memory.
+        self.assertEqual(self.db._conn.execute("PRAGMA cache_size").fetchone()[0], -65536)
+        self.assertEqual(self.db._conn.execute("PRAGMA temp_store").fetchone()[0], 2)
+
     def test_get_file(self):
         self.db = FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db")
 
@@ -99,6 +152,30 @@ class TestFileMetadataDb(unittest.TestCase):
         self.assertIsInstance(did_exist, bool)
         self.assertFalse(did_exist)
 
+    def test_does_exist_many(self):
+        self.db = self.create_new_database()
+        self.db.add_files(self.expected_files)
+        self.db.commit()
+
+        paths = [x.path_str for x in self.expected_files]
+        self.assertEqual(self.db.does_exist_many(paths), set(paths))
+        self.assertEqual(self.db.does_exist_many([]), set())
+
+        # Enough paths to need more than one query.
+        missing = [f"/nonexistant/{i}" for i in range(1200)]
+        self.assertEqual(self.db.does_exist_many(missing + [Path(paths[0])]), {paths[0]})
+
+
+    def test_get_hash_if_metadata_matches(self):
+        self.db = FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db")
+        row = next(self.db.get_all_files())
+        path = str(row.path)
+
+        self.assertEqual(self.db.get_hash_if_metadata_matches(path, row.size, row.mtime), row.hash)
+        # Any difference in size or mtime means the stored hash can't be trusted.
+        self.assertIsNone(self.db.get_hash_if_metadata_matches(path, row.size + 1, row.mtime))
+        self.assertIsNone(self.db.get_hash_if_metadata_matches(path, row.size, row.mtime + 1))
+        self.assertIsNone(self.db.get_hash_if_metadata_matches("nonexistant", row.size, row.mtime))
 
     def test_add_file(self):
         self.db = self.create_new_database()
@@ -146,6 +223,73 @@ class TestFileMetadataDb(unittest.TestCase):
             # Database is in read only mode, so this should fail
             self.db.add_file(fake_file)
 
+    def test_add_files(self):
+        self.db = self.create_new_database()
+
+        with self.assertRaises(TypeError):
+            # Every file should be a FileMetadata object.
+            self.db.add_files(["testing"])
+
+        self.db.add_files(self.expected_files)
+        self.db.commit()
+
+        for file in self.expected_files:
+            self.assertEqual(self.db.get_file(file), file)
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            # These files already exist in the database.
+            self.db.add_files(self.expected_files[:1])
+
+        self.db.close()
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        with self.assertRaises(RuntimeError):
+            # Database is in read only mode, so this should fail
+            self.db.add_files(self.expected_files)
+
+    def test_upsert_files(self):
+        self.db = self.create_new_database()
+
+        orig_file = DbFileMetadata({
+            "path": "tests/resources/common/test_files/filexyz.txt",
+            "size": 9991,
+            "hash": bytes.fromhex("b1ab25c55913d95bc691331dbce9bffff5ebf00a64553a8ef194193e52ea5015"),
+            "mtime": 1141212117524000000,
+            "fs_id": 234
+        })
+
+        updated_file = DbFileMetadata({
+            "path": "tests/resources/common/test_files/filexyz.txt",
+            "size": 888,
+            "hash": bytes.fromhex("aaaaaac55913d95bc691331dbce9bffff5ebf00a64553a8ef194193e52ea5015"),
+            "mtime": 1111123417524000000,
+            "fs_id": 456
+        })
+
+        self.db.upsert_files([orig_file])
+        self.assertEqual(self.db.get_file(orig_file), orig_file)
+
+        # Existing files are replaced, new files are added.
+        self.db.upsert_files([updated_file] + self.expected_files)
+        self.assertEqual(self.db.get_file(orig_file), updated_file)
+        self.assertEqual(len(list(self.db.get_all_files())), len(self.expected_files) + 1)
+
+        with self.assertRaises(TypeError):
+            self.db.upsert_files(["testing"])
+
+        # Single files can be upserted as well.
+        self.db.upsert_file(orig_file)
+        self.assertEqual(self.db.get_file(orig_file), orig_file)
+        with self.assertRaises(TypeError):
+            self.db.upsert_file("testing")
+
+        self.db.commit()
+        self.db.close()
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        with self.assertRaises(RuntimeError):
+            self.db.upsert_files([updated_file])
+        with self.assertRaises(RuntimeError):
+            self.db.upsert_file(updated_file)
+
     def test_update_file(self):
         self.db = self.create_new_database()
 
@@ -189,6 +333,41 @@ class TestFileMetadataDb(unittest.TestCase):
             #Can't update a file when database is in read only mode.
             self.db.update_file(updated_file)
 
+    def test_update_files(self):
+        self.db = self.create_new_database()
+        self.db.add_files(self.expected_files)
+
+        updated_files = [DbFileMetadata({
+            "path": str(file.path),
+            "size": file.size + 1,
+            "hash": bytes(32),
+            "mtime": file.mtime + 1,
+            "fs_id": file.fs_id
+        }) for file in self.expected_files]
+
+        self.db.update_files(updated_files)
+        for file in updated_files:
+            self.assertEqual(self.db.get_file(file), file)
+
+        with self.assertRaises(FileNotFoundError):
+            # One of these files doesn't exist in the database.
+            self.db.update_files(updated_files[:1] + [DbFileMetadata({
+                "path": "nonexistant",
+                "size": 1,
+                "hash": bytes(32),
+                "mtime": 2,
+                "fs_id": 3
+            })])
+
+        with self.assertRaises(TypeError):
+            self.db.update_files(["testing"])
+
+        self.db.commit()
+        self.db.close()
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        with self.assertRaises(RuntimeError):
+            self.db.update_files(updated_files)
+
     def test_remove_file(self):
         self.db = self.create_new_database()
 
@@ -222,6 +401,44 @@ class TestFileMetadataDb(unittest.TestCase):
             self.db.remove_file(fake_file)
 
 
+    def test_remove_files(self):
+        self.db = self.create_new_database()
+        self.db.add_files(self.expected_files)
+
+        self.db.remove_files(self.expected_files[1:])
+        self.assertTrue(self.db.does_exist(self.expected_files[0]))
+        for file in self.expected_files[1:]:
+            self.assertFalse(self.db.does_exist(file))
+
+        with self.assertRaises(FileNotFoundError):
+            self.db.remove_files(self.expected_files[:2])
+        with self.assertRaises(TypeError):
+            self.db.remove_files(["testing"])
+        self.db.commit()
+
+        self.db.close()
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        with self.assertRaises(RuntimeError):
+            self.db.remove_files(self.expected_files[:1])
+
+    def test_get_files_many(self):
+        self.db = self.create_new_database()
+        self.db.add_files(self.expected_files)
+        self.db.commit()
+
+        paths = [str(x.path) for x in self.expected_files]
+        files = self.db.get_files_many(paths)
+        self.assertIsInstance(files, list)
+        self.assertEqual(sorted(str(x.path) for x in files), sorted(paths))
+        for file in files:
+            self.assertIsInstance(file, DbFileMetadata)
+            self.assertEqual(file, self.db.get_file(file))
+        self.assertEqual(self.db.get_files_many([]), [])
+
+        # Enough paths to need more than one query.
+        missing = [f"/nonexistant/{i}" for i in range(1200)]
+        self.assertEqual([str(x.path) for x in self.db.get_files_many(missing + [Path(paths[0])])], [paths[0]])
+
     def test_get_all_files(self):
         self.db = FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db")
 
@@ -271,6 +488,30 @@ class TestFileMetadataDb(unittest.TestCase):
             for file in self.db.get_files_matching_hash(bytes([20] * 64)):
                 pass
 
+    def test_iter_duplicate_groups(self):
+        self.db = FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db")
+
+        expected_paths = [
+            "tests/resources/common/test_files/file with spaces 2.txt",
+            "tests/resources/common/test_files/folder1/folder with spaces/file with spaces.txt"
+        ]
+
+        groups = list(self.db.iter_duplicate_groups())
+        self.assertEqual(len(groups), 1)
+
+        file_hash, paths = groups[0]
+        self.assertEqual(file_hash, bytes.fromhex("4bea3e0214a5d4ff2b9cf9badb4d007b079d649a85117a74f1e04d47a875abbe"))
+        for path in paths:
+            self.assertIsInstance(path, Path)
+        # Handle cross platform separators
+        self.assertCountEqual(expected_paths, [str(x).replace("\\", "/") for x in paths])
+
+        # Files that only have a unique hash never show up.
+        self.db.close()
+        self.db = self.create_new_database()
+        self.db.add_files(self.expected_files[2:])
+        self.assertEqual(list(self.db.iter_duplicate_groups()), [])
+
     def test_get_files_matching_regex(self):
         self.db = FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db")
 
@@ -292,6 +533,78 @@ class TestFileMetadataDb(unittest.TestCase):
         for file in self.db.get_files_matching_regex(r"nonexistant"):
             raise ValueError("This regex should never match anything.")
 
+    def test_get_files_matching_regex_prefix(self):
+        self.db = self.create_new_database()
+        paths = ["/a/b/file1.txt", "/a/b/file2.txt", "/a/bc/file3.txt", "/a/c/file4.txt", "/b/file5.txt"]
+        self.db.add_files(DbFileMetadata({
+            "path": path,
+            "size": 1,
+            "hash": bytes(32),
+            "mtime": 2,
+            "fs_id": 3
+        }) for path in paths)
+
+        def matching(regex):
+            return sorted(x.path_str for x in self.db.get_files_matching_regex(regex))
+
+        self.assertEqual(matching(r"/a/b/"), paths[:2])
+        self.assertEqual(matching(r"^/a/bc?/file[13]"), [paths[0], paths[2]])
+        self.assertEqual(matching(r"/a/c|/b/"), paths[3:])
+        self.assertEqual(matching(re.compile(r"/a/.*4")), [paths[3]])
+        self.assertEqual(matching(r".*\.txt$"), paths)
+
+        with self.assertRaises(ValueError):
+            matching(re.compile(r"/A/", re.IGNORECASE))
+
+    def test_get_metadata_index(self):
+        self.db = self.create_new_database()
+        self.assertEqual(self.db.get_metadata_index(), {})
+
+        self.db.add_files(self.expected_files)
+        self.db.commit()
+        self.assertEqual(self.db.get_metadata_index(), {
+            x.path_str: (x.size, x.mtime, x.fs_id) for x in self.expected_files
+        })
+
+    def test_get_files_matching_name(self):
+        self.db = self.create_new_database()
+        paths = ["/a/b/file1.txt", "/a/file.txt/file2.csv", "/b/other.txt", "C:\\b\\file3.txt", "file4.txt"]
+        self.db.add_files(DbFileMetadata({
+            "path": path,
+            "size": 1,
+            "hash": bytes(32),
+            "mtime": 2,
+            "fs_id": 3
+        }) for path in paths)
+
+        def matching(pattern):
+            return sorted(x.path_str for x in self.db.get_files_matching_name(pattern))
+
+        self.assertEqual(matching("file*.txt"), sorted([paths[0], paths[3], paths[4]]))
+        self.assertEqual(matching("*.csv"), [paths[1]])
+        self.assertEqual(matching("other.txt"), [paths[2]])
+        # Directories aren't part of the name.
+        self.assertEqual(matching("b"), [])
+        self.assertEqual(matching("File*"), [])
+
+        with self.assertRaises(TypeError):
+            matching(re.compile("file"))
+
+        query_plan = self.db._conn.execute(
+            "EXPLAIN QUERY PLAN " + file_metadata_db._SQL_MATCHING_NAME, ("file*",)
+        ).fetchall()
+        self.assertIn("idx_files_name", str([tuple(x) for x in query_plan]))
+
+    def test_literal_prefix(self):
+        self.assertEqual(FileMetadataDb._literal_prefix(r"/a/b"), "/a/b")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"^/a/b.*"), "/a/b")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"/a/bc?"), "/a/b")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"/a/bc+"), "/a/bc")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"/a\.b"), "/a")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"/a|/b"), "")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"(?i)/a"), "")
+        self.assertEqual(FileMetadataDb._literal_prefix(r"abc(?i)"), "")
+
     def test_commit(self):
         self.db = self.create_new_database()
 
@@ -301,6 +614,39 @@ class TestFileMetadataDb(unittest.TestCase):
         self.db.commit()
         self.db.commit()
 
+    def test_transaction(self):
+        self.db = self.create_new_database()
+        self.assertFalse(self.db.in_transaction)
+
+        # Changes stay uncommitted until `commit` is called.
+        self.db.add_file(self.expected_files[0])
+        self.assertTrue(self.db.in_transaction)
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                pass
+        self.db.commit()
+        self.assertFalse(self.db.in_transaction)
+
+        with self.db.transaction():
+            self.db.add_files(self.expected_files[1:])
+            self.assertTrue(self.db.in_transaction)
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(len(list(self.db.get_all_files())), len(self.expected_files))
+
+        # Everything in a failed transaction is rolled back.
+        with self.assertRaises(ValueError):
+            with self.db.transaction():
+                self.db.remove_file(self.expected_files[0])
+                raise ValueError()
+        self.assertFalse(self.db.in_transaction)
+        self.assertTrue(self.db.does_exist(self.expected_files[0]))
+
+        self.db.close()
+        self.db = FileMetadataDb(self.db_file, readonly=True)
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                pass
+
     def test_close(self):
         self.db = self.create_new_database()
 
@@ -309,11 +655,43 @@ class TestFileMetadataDb(unittest.TestCase):
         self.db.close()
         self.db.close()
 
+        # The WAL is checkpointed and emptied on close, even if another
+        # connection still has the database open.
+        self.db = FileMetadataDb(self.db_file, readonly=False)
+        other_db = FileMetadataDb(self.db_file, readonly=True)
+        self.db.add_files(self.expected_files)
+        self.db.commit()
+        wal_file = Path(str(self.db_file) + "-wal")
+        self.assertGreater(wal_file.stat().st_size, 0)
+        self.db.close()
+        self.assertEqual(wal_file.stat().st_size, 0)
+        self.assertEqual(len(list(other_db.get_all_files())), len(self.expected_files))
+
+        # Databases that are never closed are closed once garbage collected.
+        conn = other_db._conn
+        del other_db
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1;")
+
     def test_db_path(self):
         self.db = self.create_new_database()
 
         self.assertEqual(str(self.db_file.resolve()), self.db.db_path)
 
+    def test_hash_algorithm(self):
+        # Databases created before the algorithm could be chosen are SHA256.
+        with FileMetadataDb("tests/resources/test_file_metadata_db/common/basic_db.db") as db:
+            self.assertEqual(db.hash_algorithm, "sha256")
+
+        self.db = self.create_new_database()
+        self.assertEqual(self.db.hash_algorithm, "sha256")
+        self.db.close()
+        self.db_file.unlink()
+
+        with self.assertRaises(ValueError):
+            self.db = FileMetadataDb(self.db_file, readonly=False, create_new_db=True, hash_algorithm="md5")
+        self.assertFalse(self.db_file.exists())
+
 
 if __name__ == "__main__":
     unittest.main()
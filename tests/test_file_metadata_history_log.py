@@ -0,0 +1,104 @@
+import csv
+import gzip
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from file_tracker.file_metadata import DbFileMetadata
+from file_tracker.file_metadata_history_log import FileMetadataHistoryLog
+
+class TestFileMetadataHistoryLog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log_file = Path(self.temp_dir.name) / "log.csv.gz"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def create_file(self, path: str) -> DbFileMetadata:
+        return DbFileMetadata({
+            "path": path,
+            "size": 1,
+            "hash": bytes(range(32)),
+            "mtime": 2,
+            "fs_id": 3
+        })
+
+    def test_add(self):
+        paths = ["/a/file.txt", "/a/file, with comma.txt", '/a/file "quoted".txt', "/a/file\nnewline.txt"]
+
+        with FileMetadataHistoryLog(self.log_file) as history:
+            history.add("new", "new_file", self.create_file(paths[0]))
+            history.add("update", "changed", self.create_file(paths[1]))
+            history.add("skip", "unchanged", self.create_file(paths[2]))
+            history.add("delete", "nonexistent", self.create_file(paths[3]))
+
+            with self.assertRaises(ValueError):
+                history.add("new", "unchanged", self.create_file(paths[0]))
+            with self.assertRaises(ValueError):
+                history.add("nonexistant", "new_file", self.create_file(paths[0]))
+            with self.assertRaises(TypeError):
+                history.add("new", "new_file", paths[0])
+
+        with self.assertRaises(ValueError):
+            # The log has been closed.
+            history.add("new", "new_file", self.create_file(paths[0]))
+
+        with gzip.open(self.log_file, mode="rt", encoding="utf8", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+        expected_hash = bytes(range(32)).hex()
+        self.assertEqual(rows, [
+            {"action": "new", "reason": "new_file", "path": paths[0], "new_hash": expected_hash},
+            {"action": "update", "reason": "changed", "path": paths[1], "new_hash": expected_hash},
+            {"action": "skip", "reason": "unchanged", "path": paths[2], "new_hash": ""},
+            {"action": "delete", "reason": "nonexistent", "path": paths[3], "new_hash": ""}
+        ])
+
+    def test_matches_csv_module(self):
+        file = self.create_file('/a/b, "c"')
+        with FileMetadataHistoryLog(self.log_file, compression="none") as history:
+            history.add("skip", "unchanged", file)
+
+        expected = io.StringIO(newline="")
+        writer = csv.writer(expected)
+        writer.writerow(["action", "reason", "path", "new_hash"])
+        writer.writerow(["skip", "unchanged", file.path_str, ""])
+        self.assertEqual(self.log_file.read_bytes(), expected.getvalue().encode("utf8"))
+
+        with self.assertRaises(FileExistsError):
+            FileMetadataHistoryLog(self.log_file)
+
+    def test_flush(self):
+        history = FileMetadataHistoryLog(self.log_file, compression="none")
+        history.add("skip", "unchanged", self.create_file("/a/file.txt"))
+        # Entries are buffered until flushed, which closing does as well.
+        self.assertEqual(self.log_file.read_bytes(), b"")
+        history.close()
+        self.assertEqual(self.log_file.read_bytes(), b"action,reason,path,new_hash\r\nskip,unchanged,/a/file.txt,\r\n")
+
+        with self.assertRaises(ValueError):
+            history.flush()
+
+    def test_compression(self):
+        with self.assertRaises(ValueError):
+            FileMetadataHistoryLog(self.log_file, compression="bzip2")
+        with self.assertRaises(TypeError):
+            FileMetadataHistoryLog(self.log_file, True, compression="gzip")
+        self.assertFalse(self.log_file.exists())
+
+    def test_gzip_compress(self):
+        # The deprecated flag still picks between gzip and no compression.
+        with self.assertWarns(DeprecationWarning):
+            FileMetadataHistoryLog(self.log_file, False).close()
+        self.assertEqual(self.log_file.read_bytes(), b"action,reason,path,new_hash\r\n")
+
+        gzip_log_file = self.log_file.with_name("gzip_log.csv.gz")
+        with self.assertWarns(DeprecationWarning):
+            FileMetadataHistoryLog(gzip_log_file, gzip_compress=True).close()
+        self.assertEqual(gzip.decompress(gzip_log_file.read_bytes()), b"action,reason,path,new_hash\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
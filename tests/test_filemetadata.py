@@ -1,6 +1,8 @@
+import os
+import tempfile
 import unittest
 from pathlib import Path
-from file_tracker.file_metadata import DbFileMetadata, FileMetadata
+from file_tracker.file_metadata import DbFileMetadata, FileMetadata, SharedRowValues, hash_many, hash_small_files_batch
 from tests import utils
 
 
@@ -31,10 +33,144 @@ class TestFileMetadata(unittest.TestCase):
             self.assertEqual(fm.hash, file["hash"])
             # We can't verify fs_id because it varies per system.
 
-            sql_dict = fm.as_sql_dict(include_hash=True)
+            sql_dict = dict(fm.as_sql_dict(include_hash=True)) # The returned dict is shared
             sql_dict["fs_id"] = file["fs_id"]
 
             self.assertEqual(sql_dict, file)
 
+
+class TestFileMetadataStandalone(unittest.TestCase):
+    """Tests that don't need the fixture files `TestFileMetadata` sets up."""
+    def test_hash_many(self):
+        walk_dir = Path("./tests/resources/test_utils/")
+        files = [FileMetadata(x) for x in walk_dir.rglob("*") if x.is_file()]
+
+        # The expected hashes are computed one file at a time.
+        expected_results = {x.path_str: FileMetadata(x.path).hash for x in files}
+
+        self.assertDictEqual(hash_many(files), expected_results)
+        self.assertDictEqual(hash_many(files[:1]), {files[0].path_str: files[0].hash})
+        self.assertDictEqual(hash_many([]), {})
+
+        # Files that disappeared before being hashed can be skipped.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            missing_path = Path(temp_dir) / "missing.txt"
+            missing_path.write_text("abc")
+            missing = FileMetadata(missing_path)
+            missing_path.unlink()
+
+            with self.assertRaises(FileNotFoundError):
+                hash_many(files + [missing])
+
+            self.assertDictEqual(hash_many(files + [missing], ignore_errors=True), expected_results)
+
+    def test_hash_small_files_batch(self):
+        walk_dir = Path("./tests/resources/test_utils/")
+        files = [FileMetadata(x) for x in walk_dir.rglob("*") if x.is_file()]
+
+        expected_results = {x.path_str: FileMetadata(x.path).hash for x in files}
+
+        self.assertDictEqual(hash_small_files_batch(files), expected_results)
+
+    def test_adopt_hash_if_unchanged(self):
+        file_path = Path("./tests/resources/test_utils/test_walk_files/file1.txt")
+        fake_hash = bytes(32)
+
+        stored = DbFileMetadata({
+            "path": str(file_path.resolve()),
+            "hash": fake_hash,
+            "size": file_path.stat().st_size,
+            "mtime": file_path.stat().st_mtime_ns,
+            "fs_id": 123
+        })
+
+        fm = FileMetadata(file_path)
+        self.assertTrue(fm.adopt_hash_if_unchanged(stored))
+        # The adopted hash is used as is, without reading the file.
+        self.assertEqual(fm.hash, fake_hash)
+
+        changed = DbFileMetadata(dict(stored.as_sql_dict(include_hash=True), mtime=stored.mtime + 1))
+        fm = FileMetadata(file_path)
+        self.assertFalse(fm.adopt_hash_if_unchanged(changed))
+        self.assertNotEqual(fm.hash, fake_hash)
+
+    def test_as_sql_dict(self):
+        fm = FileMetadata(Path("./tests/resources/test_utils/test_walk_files/file1.txt"))
+
+        without_hash = fm.as_sql_dict()
+        self.assertIsNone(without_hash["hash"])
+        self.assertEqual(without_hash["path"], str(fm.path))
+
+        with_hash = fm.as_sql_dict(include_hash=True)
+        self.assertEqual(with_hash["hash"], fm.hash)
+
+        # Both variants are cached separately.
+        self.assertIs(fm.as_sql_dict(), without_hash)
+        self.assertIs(fm.as_sql_dict(include_hash=True), with_hash)
+        self.assertIsNone(fm.as_sql_dict()["hash"])
+
+    def test_from_dir_entry(self):
+        walk_dir = Path("./tests/resources/test_utils/test_walk_files/")
+
+        with os.scandir(walk_dir.resolve()) as it:
+            entries = list(it)
+
+        for entry in entries:
+            if entry.is_dir():
+                with self.assertRaises(FileNotFoundError):
+                    FileMetadata.from_dir_entry(entry)
+                continue
+
+            fm = FileMetadata.from_dir_entry(entry)
+            expected = FileMetadata(Path(entry.path))
+            self.assertEqual(fm.path_str, entry.path)
+            self.assertEqual(fm.hash, expected.hash)
+            self.assertEqual(fm, expected)
+            self.assertIsInstance(fm.path, Path)
+            self.assertEqual(FileMetadata.from_dir_entry(entry, resolve=True), expected)
+
+        with self.assertRaises(TypeError):
+            FileMetadata.from_dir_entry(walk_dir)
+
+        with self.assertRaises(ValueError):
+            FileMetadata.from_dir_entry(next(x for x in entries if x.is_file()), hash_algorithm="md5")
+
+    def test_from_trusted_row(self):
+        row = {
+            "path": str(Path("/some/dir/file.txt")),
+            "hash": bytes(32),
+            "size": 10,
+            "mtime": 20,
+            "fs_id": 30
+        }
+
+        fm = DbFileMetadata.from_trusted_row(row)
+        self.assertIsInstance(fm, DbFileMetadata)
+        self.assertEqual(fm, DbFileMetadata(row))
+        self.assertEqual(fm.path_str, row["path"])
+        self.assertEqual(fm.as_sql_dict(include_hash=True), row)
+
+        fm = DbFileMetadata.from_sql_tuple(fm.as_sql_tuple(include_hash=True))
+        self.assertEqual(fm, DbFileMetadata(row))
+        self.assertEqual(fm.hash_hex, "00" * 32)
+
+        # Files read with the same `SharedRowValues` share their parent.
+        shared = SharedRowValues()
+        other_row = dict(row, path=str(Path("/some/dir/other.txt")))
+        fm = DbFileMetadata.from_sql_tuple(tuple(row.values()), shared)
+        other = DbFileMetadata.from_sql_tuple(tuple(other_row.values()), shared)
+        self.assertEqual(other.path_str, other_row["path"])
+        self.assertIs(other.path_str, other.path_str)
+        self.assertIs(fm._parent, other._parent)
+        self.assertEqual(shared.parents, {fm._parent: fm._parent})
+        self.assertEqual(shared.fs_ids, {fm.fs_id: fm.fs_id})
+
+    def test_as_sql_tuple(self):
+        fm = FileMetadata(Path("./tests/resources/test_utils/test_walk_files/file1.txt"))
+
+        sql_dict = fm.as_sql_dict(include_hash=True)
+        self.assertEqual(fm.as_sql_tuple(include_hash=True), tuple(sql_dict[x] for x in ("path", "hash", "size", "mtime", "fs_id")))
+        self.assertIsNone(fm.as_sql_tuple()[1])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,46 @@
+import tempfile
+import unittest
+from collections import Counter
+from pathlib import Path
+
+from file_tracker import update_database, utils
+from file_tracker.file_metadata_db import FileMetadataDb
+from file_tracker.file_metadata_history_log import FileMetadataHistoryLog
+from file_tracker.logger import Logger
+
+class TestUpdateDatabase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_path = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_register_new_files_symlinked_fs(self):
+        fs_dir = self.temp_path / "fs"
+        (fs_dir / "sub").mkdir(parents=True)
+        (fs_dir / "file1.txt").write_text("abc")
+        (fs_dir / "sub" / "file2.txt").write_text("def")
+        link = self.temp_path / "link"
+        link.symlink_to(fs_dir, target_is_directory=True)
+
+        # The filesystem is registered through a symlink to it.
+        filesystems = {str(link): utils.get_fsid(link)}
+        stats: Counter[str] = Counter()
+        with Logger(self.temp_path / "log.log") as log, \
+             FileMetadataHistoryLog(self.temp_path / "history.csv.gz") as history, \
+             FileMetadataDb(self.temp_path / "db.db", readonly=False, create_new_db=True) as db:
+            for walker_threads in (1, 4):
+                update_database.register_new_files(db, {}, filesystems, log, history, stats, walker_threads)
+                paths = sorted(x.path_str for x in db.get_all_files())
+
+                # Files are stored under their resolved paths.
+                resolved = fs_dir.resolve()
+                self.assertEqual(paths, [str(resolved / "file1.txt"), str(resolved / "sub" / "file2.txt")])
+                db.remove_files(db.get_files_many(paths))
+
+        self.assertEqual(stats["added"], 4)
+        self.assertEqual(stats["error"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
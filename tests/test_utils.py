@@ -1,5 +1,7 @@
+import os
 import unittest
 from pathlib import Path
+from unittest import mock
 
 from file_tracker import utils
 
@@ -16,6 +18,14 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(ValueError):
             utils.assert_sql_safe_chars("hello world")
 
+        # Characters sorting between "Z" and "a" aren't letters.
+        for string in ("abc[xyz", "abc_xyz", "abc^xyz", "abc\\xyz"):
+            with self.assertRaises(ValueError):
+                utils.assert_sql_safe_chars(string)
+
+        with self.assertRaises(ValueError):
+            utils.assert_sql_safe_chars("abc\n")
+
         with self.assertRaises(TypeError):
             utils.assert_sql_safe_chars(123)
 
@@ -36,16 +46,87 @@ class TestUtils(unittest.TestCase):
     def test_get_fsid(self):
         fsid = utils.get_fsid(Path("."))
         self.assertIsInstance(fsid, int)
+        # Once looked up by st_dev, the fsid is cached for the whole device.
+        st_dev = os.stat(".").st_dev
+        self.assertEqual(utils.get_fsid(".", st_dev), fsid)
+        self.assertEqual(utils.get_fsid("./tests", st_dev), fsid)
 
     def test_walk_files(self):
         walk_dir = Path("./tests/resources/test_utils/test_walk_files/")
-        expected_results = set([str(x) for x in walk_dir.rglob("*") if x.is_file()])
+        expected_results = set()
+        for root, _, files in os.walk(walk_dir):
+            expected_results.update(os.path.join(root, x) for x in files)
 
         result_files = set()
         for file in utils.walk_files(walk_dir, lambda x: x): # No good way to test error handler.
-            result_files.add(str(file))
+            self.assertIsInstance(file, os.DirEntry)
+            result_files.add(file.path)
 
         self.assertSetEqual(expected_results, result_files)
 
+    def test_walk_files_listing_error(self):
+        walk_dir = Path("./tests/resources/test_utils/test_walk_files/")
+        expected_results = set(x.path for x in utils.walk_files(walk_dir, lambda x: x))
+        scandir = os.scandir
+
+        class FailingScandir:
+            """Lists the first entry of a directory, then fails."""
+            def __init__(self, path):
+                self._it = scandir(path)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self._it.close()
+
+            def __iter__(self):
+                for entry in self._it:
+                    yield entry
+                    break
+                raise PermissionError("Listing failed.")
+
+        for walk in (utils.walk_files, utils.walk_files_parallel):
+            errors = []
+            with mock.patch("os.scandir", FailingScandir):
+                result_files = set(x.path for x in walk(walk_dir, errors.append))
+
+            # Every directory listed fails, but the walk carries on.
+            self.assertTrue(errors)
+            for error in errors:
+                self.assertIsInstance(error, PermissionError)
+            self.assertTrue(result_files <= expected_results)
+
+    def test_walk_files_parallel(self):
+        walk_dir = Path("./tests/resources/test_utils/test_walk_files/")
+        expected_results = set(x.path for x in utils.walk_files(walk_dir, lambda x: x))
+
+        for workers in (1, 4):
+            result_files = set()
+            for file in utils.walk_files_parallel(walk_dir, lambda x: x, workers=workers):
+                self.assertIsInstance(file, os.DirEntry)
+                result_files.add(file.path)
+            self.assertSetEqual(expected_results, result_files)
+
+        # Errors are passed to the handler, like with `walk_files`.
+        errors = []
+        self.assertEqual(list(utils.walk_files_parallel(walk_dir / "nonexistant", errors.append)), [])
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], FileNotFoundError)
+
+        # Stopping early shouldn't leave anything blocked.
+        walker = utils.walk_files_parallel(walk_dir, lambda x: x)
+        next(walker)
+        walker.close()
+
+        # Errors other than OSErrors aren't handled, but still end the walk.
+        # A null byte makes `os.scandir` raise a ValueError.
+        with self.assertRaises(ValueError):
+            list(utils.walk_files_parallel(f"{walk_dir}\0", errors.append))
+        self.assertEqual(len(errors), 1)
+
+        with self.assertRaises(ValueError):
+            next(utils.walk_files_parallel(walk_dir, lambda x: x, workers=0))
+
 if __name__ == "__main__":
     unittest.main()
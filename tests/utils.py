@@ -1,3 +1,4 @@
+import functools
 import json
 import os
 from pathlib import Path
@@ -8,20 +9,23 @@ def set_utimes_on_test_files() -> None:
     if "file_tracker" not in str(Path().resolve()) or not Path(".gitignore").is_file():
         raise Exception("We must be in the root of the repo dir to complete this test.")
 
-    with Path("./tests/resources/common/expected.json").open(mode="rt") as f:
-        expected_files = json.load(f)
-
-    for file in expected_files:
+    for file in _load_expected_files():
         file_path = file["path"]
         file_mtime_ns = file["mtime"]
         os.utime(file_path, ns=(0, file_mtime_ns))
 
 def get_expected_files() -> list[dict[str, str|int|bytes]]:
     """Parses the JSON at ./tests/resources/common/expected.json and returns it"""
+    # Each call gets its own copies, so tests are free to modify them.
+    return [dict(file) for file in _load_expected_files()]
+
+@functools.lru_cache(maxsize=1)
+def _load_expected_files() -> tuple[dict[str, str|int|bytes], ...]:
+    """Parses expected.json once, every test module shares the result."""
     with Path("./tests/resources/common/expected.json").open(mode="rt") as f:
         file_objs = json.load(f)
 
     for file in file_objs:
         file["hash"] = bytes.fromhex(file["hash"])
 
-    return file_objs
\ No newline at end of file
+    return tuple(file_objs)